@@ -0,0 +1,294 @@
+"""
+    Offline benchmark suite for the parse, transform and fetch hot paths.
+
+    Scales the fixtures in test/fixtures up to many spots, times each case
+    and reports latency percentiles, throughput and peak traced memory.
+
+        python benchmark.py --spots 100 --output results.json
+        python benchmark.py --compare results.json
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import tempfile
+import threading
+import tracemalloc
+from datetime import datetime as dt
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import magicseaweed
+
+try:
+    from flatten_json import flatten as flatten_json
+except ImportError:
+    flatten_json = None
+
+FIXTURE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'test',
+                       'fixtures', 'success_response.json')
+API_KEY = 'benchmark'
+REPEAT = 20
+SPOTS = 100
+
+with open(FIXTURE, 'r') as f:
+    raw = f.read()
+    payload = json.loads(raw)
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """Serves the fixture payload for every GET."""
+    body = raw.encode('utf-8')
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(self.body)))
+        self.end_headers()
+        self.wfile.write(self.body)
+
+    def log_message(self, *args):
+        pass
+
+
+class StubServer(ThreadingHTTPServer):
+    request_queue_size = 128
+    daemon_threads = True
+
+
+def start_stub_server():
+    """Start the stub server on a free local port, return (server, url)."""
+    server = StubServer(('127.0.0.1', 0), StubHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, 'http://127.0.0.1:{}/'.format(server.server_port)
+
+
+def percentile(ordered, fraction):
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def bench(name, func, items, repeat=REPEAT):
+    """
+        Time func repeat times after one warm-up call. items is the number
+        of points, spots or requests one call processes.
+    """
+    func()
+    latencies = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        latencies.append(time.perf_counter() - start)
+    latencies.sort()
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    mean = sum(latencies) / len(latencies)
+    return {
+        'name': name,
+        'items': items,
+        'repeat': repeat,
+        'p50_ms': percentile(latencies, 0.50) * 1e3,
+        'p95_ms': percentile(latencies, 0.95) * 1e3,
+        'p99_ms': percentile(latencies, 0.99) * 1e3,
+        'items_per_sec': items / mean if mean else float('inf'),
+        'peak_kib': peak / 1024,
+    }
+
+
+def block_all_attrs(block):
+    """Materialise every lazy attribute of block."""
+    return [(point.attrs, point.summary) for point in block.data], \
+        block.summary
+
+
+def retained_blocks(spots, compact):
+    """
+        Parse and keep spots blocks alive with every point's attrs read, so
+        peak memory compares full and compact points like for like.
+    """
+    kept = []
+    for _ in range(spots):
+        block = magicseaweed.ForecastDataBlock(json.loads(raw),
+                                               compact=compact)
+        [point.attrs for point in block.data]
+        kept.append(block)
+    return kept
+
+
+def cases(spots):
+    """Yield (name, func, items, repeat) for every in-process case."""
+    points = payload * spots
+    flats = [magicseaweed._flatten(d) for d in points]
+    projection = magicseaweed.compile_fields(
+        'timestamp,localTimestamp,wind.*')
+    timestamps = [d['localTimestamp'] for d in points]
+    spot_ids = [str(i) for i in range(spots)]
+
+    yield ('flatten', lambda: [magicseaweed._flatten(d) for d in points],
+           len(points), REPEAT)
+    yield ('flatten projected',
+           lambda: [magicseaweed._flatten(d, projection.paths)
+                    for d in points], len(points), REPEAT)
+    if flatten_json is not None:
+        yield ('flatten flatten_json',
+               lambda: [dict(flatten_json(d)) for d in points],
+               len(points), 5)
+    yield ('forecast_transform',
+           lambda: [magicseaweed._forecast_transform(f_d) for f_d in flats],
+           len(points), REPEAT)
+    yield ('labels strftime',
+           lambda: [dt.utcfromtimestamp(t).strftime('%a %-I %p')
+                    for t in timestamps], len(points), 5)
+    yield ('labels time_labels',
+           lambda: magicseaweed.time_labels(timestamps), len(points), REPEAT)
+    yield ('ForecastDataPoint attrs',
+           lambda: [magicseaweed.ForecastDataPoint(d).attrs for d in points],
+           len(points), REPEAT)
+    yield ('CompactDataPoint',
+           lambda: [magicseaweed.CompactDataPoint(d) for d in points],
+           len(points), REPEAT)
+    yield ('block construct only',
+           lambda: [len(magicseaweed.ForecastDataBlock(payload).data)
+                    for _ in range(spots)], spots, REPEAT)
+    yield ('block one field',
+           lambda: [[point.wind_speed for point in
+                     magicseaweed.ForecastDataBlock(payload).data]
+                    for _ in range(spots)], spots, REPEAT)
+    yield ('block all attrs',
+           lambda: [block_all_attrs(magicseaweed.ForecastDataBlock(payload))
+                    for _ in range(spots)], spots, REPEAT)
+    yield ('retained full points',
+           lambda: retained_blocks(spots, False), spots, 5)
+    yield ('retained compact points',
+           lambda: retained_blocks(spots, True), spots, 5)
+    yield ('build_request',
+           lambda: [magicseaweed.build_request(API_KEY, spot_id,
+                                               'timestamp,wind.*', 'us')
+                    for spot_id in spot_ids], spots, REPEAT)
+
+
+def fetch_cases(spots):
+    """Yield get_msw/fetch_many cases against a local stub server."""
+    server, url = start_stub_server()
+    requests_made = min(spots, 50)
+    spot_ids = [str(i) for i in range(requests_made)]
+    original = magicseaweed.MSW_URL
+    magicseaweed.MSW_URL = url + '{}'
+    client = magicseaweed.MSW_Client()
+    try:
+        yield ('get_msw requests.get',
+               lambda: [magicseaweed.get_msw(url) for _ in spot_ids],
+               requests_made, 5)
+        yield ('get_msw MSW_Client',
+               lambda: [magicseaweed.get_msw(url, client) for _ in spot_ids],
+               requests_made, 5)
+        yield ('fetch_many MSW_Client',
+               lambda: magicseaweed.fetch_many(API_KEY, spot_ids,
+                                               client=client),
+               requests_made, 5)
+    finally:
+        client.close()
+        magicseaweed.MSW_URL = original
+        server.shutdown()
+        server.server_close()
+
+
+def snapshot_cases(spots):
+    """Yield mmap snapshot loads against json.load of the same payload."""
+    with tempfile.TemporaryDirectory() as path:
+        filename = os.path.join(path, 'block.msw')
+        magicseaweed.ForecastDataBlock(payload).save(filename)
+
+        def load_json():
+            for _ in range(spots):
+                with open(FIXTURE, 'r') as f:
+                    json.load(f)
+
+        def load_column():
+            for _ in range(spots):
+                with magicseaweed.ForecastSnapshot(filename) as snapshot:
+                    sum(snapshot.column('swell_maxBreakingHeight'))
+
+        yield 'load json.load', load_json, spots, REPEAT
+        yield 'load snapshot column', load_column, spots, REPEAT
+        yield ('load snapshot block',
+               lambda: [magicseaweed.ForecastDataBlock.load(filename)
+                        for _ in range(spots)], spots, REPEAT)
+
+
+def ingest_cases(spots):
+    """Yield ingest cases over a JSONL archive, scaling the process count."""
+    with tempfile.TemporaryDirectory() as path:
+        filename = os.path.join(path, 'archive.jsonl')
+        with open(filename, 'w') as f:
+            for _ in range(spots):
+                f.write(raw.replace('\n', '') + '\n')
+        cores = os.cpu_count() or 1
+        for processes in sorted({1, 2, 4, cores}):
+            if processes <= cores:
+                yield ('ingest processes={}'.format(processes),
+                       lambda p=processes: sum(1 for _ in magicseaweed.ingest(
+                           filename, processes=p, chunk_size=16)),
+                       spots, 5)
+
+
+def run(spots, only=None):
+    """Run every case whose name contains only, returning result dicts."""
+    results = []
+    for group in (cases, fetch_cases, snapshot_cases, ingest_cases):
+        for name, func, items, repeat in group(spots):
+            if only is None or only in name:
+                results.append(bench(name, func, items, repeat))
+    return results
+
+
+def print_results(results, baseline=None):
+    """Print a results table, with p50 speedup against baseline if given."""
+    baseline = {r['name']: r for r in (baseline or [])}
+    header = '{:<28} {:>7} {:>9} {:>9} {:>9} {:>12} {:>10}'.format(
+        'case', 'items', 'p50 ms', 'p95 ms', 'p99 ms', 'items/s', 'peak KiB')
+    if baseline:
+        header += ' {:>8}'.format('vs base')
+    print(header)
+    for r in results:
+        line = ('{name:<28} {items:>7} {p50_ms:>9.2f} {p95_ms:>9.2f} '
+                '{p99_ms:>9.2f} {items_per_sec:>12.0f} {peak_kib:>10.1f}'
+                .format(**r))
+        if r['name'] in baseline:
+            line += ' {:>7.2f}x'.format(
+                baseline[r['name']]['p50_ms'] / r['p50_ms'])
+        print(line)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Benchmark magicseaweed parse, transform and fetch paths.')
+    parser.add_argument('--spots', type=int, default=SPOTS,
+                        help='spots to scale the fixture payload up to')
+    parser.add_argument('--only', help='run cases whose name contains this')
+    parser.add_argument('--output', help='write results as JSON to this path')
+    parser.add_argument('--compare', help='JSON results to compare p50 with')
+    args = parser.parse_args(argv)
+
+    results = run(args.spots, args.only)
+    baseline = None
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            baseline = json.load(f)['results']
+    print_results(results, baseline)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'spots': args.spots,
+                'created': int(time.time()),
+                'results': results,
+            }, f, indent=2)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
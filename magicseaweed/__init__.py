@@ -1,8 +1,34 @@
+import os
+import sys
+import json
+import argparse
+import logging
+import codecs
+import time
+import random
+import sqlite3
+import struct
+import mmap
+import asyncio
+import bisect
+import hashlib
+import functools
+import threading
+from array import array
+from collections import OrderedDict, deque, namedtuple
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
 from datetime import timedelta
-from flatten_json import flatten
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlsplit, urlunsplit, parse_qs, parse_qsl, urlencode
 from datetime import datetime as dt
+from urllib3.util.retry import Retry
 import requests
 
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
 
 MSW_URL = 'http://magicseaweed.com/api/{}/forecast'
 WEATHER_URL = 'http://cdnimages.magicseaweed.com/30x30/{}.png'
@@ -10,8 +36,36 @@ SWELL_ARROW_URL = 'http://cdnimages.magicseaweed.com/swellArrows/{}.png'
 WIND_ARROW_URL = 'http://cdnimages.magicseaweed.com/newWindArrows/{}.png'
 HOURS = ['12AM', '3AM', '6AM', '9AM', '12PM', '3PM', '6PM', '9PM']
 HTTP_GET = 'GET'
+NOT_MODIFIED = 304
 ERROR_RESPONSE = 'error_response'
 UNITS = ['us', 'uk', 'eu']
+DEFAULT_POOL_SIZE = 10
+DEFAULT_TIMEOUT = (3.05, 10)
+DEFAULT_RETRIES = 3
+DEFAULT_BACKOFF = 0.3
+RETRY_STATUSES = [429, 500, 502, 503, 504]
+DEFAULT_CONCURRENCY = 10
+WINDOWS = ['current', 'future', 'all', 'manual']
+DEFAULT_CACHE_SIZE = 256
+LABEL_CACHE_SIZE = 4096
+LABEL_FORMAT = '%a %-I %p'
+STREAM_CHUNK_SIZE = 8192
+ISSUE_INTERVAL = 6 * 60 * 60
+FORECAST_INTERVAL = 3 * 60 * 60
+MIN_CACHE_TTL = 5 * 60
+SNAPSHOT_MAGIC = b'MSWB'
+SNAPSHOT_VERSION = 2
+SNAPSHOT_HEADER = struct.Struct('<4sHHIIQ')
+SNAPSHOT_COLUMN = struct.Struct('<IcxxxQQ')
+MISSING_INT = -2 ** 63
+MISSING_STRING = 2 ** 32 - 1
+TAG_MISSING, TAG_NULL, TAG_VALUE, TAG_INT = range(4)
+DEFAULT_POLL_INTERVAL = 15 * 60
+INGEST_CHUNK_SIZE = 64
+DIFF_IGNORED = ('issueTimestamp',)
+HISTOGRAM_BUCKETS = (0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5,
+                     5, 10)
+TIMESTAMP_FIELDS = ['timestamp', 'localTimestamp', 'issueTimestamp']
 CHART_TYPES = ['swell', 'period', 'wind', 'pressure', 'sst']
 SWELL_TYPES = ['combined', 'primary', 'secondary', 'tertiary']
 FIELD_TYPES = ['timestamp', 'localTimestamp', 'issueTimestamp', 'fadedRating',
@@ -47,13 +101,80 @@ def _validate_field_types(field_types):
     """Validate field types"""
     chunked_field_types = field_types.split(',')
     for field_type in chunked_field_types:
-        if field_type not in FIELD_TYPES:
+        if field_type not in FIELD_SET:
             raise ValueError('Invalid field type: {}'.format(field_type))
 
 
-def _flatten(d):
-    """Flattens a multi-level dict, compressing keys."""
-    return dict(flatten(d))
+def _field_paths(field_types):
+    """Map each concrete field type to its flattened key and dict path."""
+    return tuple((field.replace('.', '_'), tuple(field.split('.')))
+                 for field in field_types if not field.endswith('*'))
+
+
+FIELD_SET = frozenset(FIELD_TYPES)
+FIELD_PATHS = _field_paths(FIELD_TYPES)
+FLAT_FIELDS = frozenset(field.replace('.', '_') for field in FIELD_TYPES)
+
+
+class FieldProjection(namedtuple('FieldProjection', 'query paths keys')):
+    """
+        Immutable, compiled field selection. query is the validated
+        fields parameter, paths the FIELD_PATHS entries it selects with
+        wildcards expanded, and keys their flattened names.
+    """
+    __slots__ = ()
+
+
+@functools.lru_cache(maxsize=DEFAULT_CACHE_SIZE)
+def compile_fields(fields):
+    """Compile a comma separated fields string into a FieldProjection."""
+    query = fields.replace(" ", "")
+    _validate_field_types(query)
+    selected = set()
+    for field in query.split(','):
+        if field.endswith('*'):
+            prefix = field[:-1]
+            selected.update(f for f in FIELD_TYPES if f.startswith(prefix))
+        else:
+            selected.add(field)
+    paths = tuple((key, path) for key, path in FIELD_PATHS
+                  if '.'.join(path) in selected)
+    return FieldProjection(query, paths, frozenset(key for key, _ in paths))
+
+
+def _flatten(d, paths=FIELD_PATHS):
+    """Flattens a forecast dict, compressing keys, in one pass over paths."""
+    f_d = {}
+    for key, path in paths:
+        value = d
+        try:
+            for part in path:
+                value = value[part]
+        except (KeyError, TypeError):
+            continue
+        f_d[key] = value
+    return f_d
+
+
+@functools.lru_cache(maxsize=LABEL_CACHE_SIZE)
+def time_label(timestamp, tz=None):
+    """
+        Label such as 'Sat 6 PM' for a unix timestamp, as UTC wall time or
+        in tz when given. Memoized, since forecasts fall on a few 3 hour
+        boundaries.
+    """
+    if tz is None:
+        return dt.utcfromtimestamp(timestamp).strftime(LABEL_FORMAT)
+    return dt.fromtimestamp(timestamp, tz).strftime(LABEL_FORMAT)
+
+
+def time_labels(timestamps, tz=None):
+    """Labels for many timestamps, formatting each distinct value once."""
+    labels = {}
+    for timestamp in timestamps:
+        if timestamp not in labels:
+            labels[timestamp] = time_label(timestamp, tz)
+    return [labels[timestamp] for timestamp in timestamps]
 
 
 def _forecast_transform(f_d):
@@ -85,8 +206,8 @@ def _forecast_transform(f_d):
         'air_pressure': "{}{}".format(air_pressure, unit_pressure),
         'air_temp': "{}° {}".format(air_temp, unit_temp),
         'stars': "{} solid, {} faded".format(solid_stars, faded_stars),
-        'begins': dt.utcfromtimestamp(begins).strftime("%a %-I %p"),
-        'issued': dt.utcfromtimestamp(issued).strftime("%a %-I %p"),
+        'begins': time_label(begins),
+        'issued': time_label(issued),
         'max_breaking_height': "{} {}".format(swell_max_breaking_height, swell_unit),
         'abs_max_breaking_height': "{} {}".format(swell_abs_max_breaking_height, swell_unit),
         'min_breaking_height': "{} {}".format(swell_min_breaking_height, swell_unit),
@@ -112,7 +233,8 @@ def build_request(api_key, spot_id, fields=None, unit=None,
                     corresponding spot on the Magic Seaweed website. IE '616' in
                     http://magicseaweed.com/Pipeline-Backdoor-Surf-Report/616/
         fields:     Comma separated list of fields to include in the request
-                    URL. Defaults to none, which returns all information. Specifying
+                    URL, or a FieldProjection from compile_fields. Defaults to
+                    none, which returns all information. Specifying
                     fields may reduce response time. Example:
                     fields=timestamp,wind.*,condition.temperature
         units:      A string of the preferred unit of measurement. Defaults to unit at
@@ -122,9 +244,9 @@ def build_request(api_key, spot_id, fields=None, unit=None,
     """
     params = {'spot_id': spot_id}
     if fields:
-        fields = fields.replace(" ", "")
-        _validate_field_types(fields)
-        params['fields'] = fields
+        if not isinstance(fields, FieldProjection):
+            fields = compile_fields(fields)
+        params['fields'] = fields.query
     if unit:
         _validate_unit_types(unit)
         params['units'] = unit
@@ -137,71 +259,1116 @@ def build_request(api_key, spot_id, fields=None, unit=None,
     return baseURL
 
 
-def get_msw(requestURL):
-    """Get MSW API response."""
-    msw_response = requests.get(requestURL)
-    msw_response.raise_for_status()
+class Observer():
+    """
+        Instrumentation hook. get_msw and the data points call observe once
+        per stage: 'cache' (hit), 'response' (connect and wait for headers;
+        status, retries), 'download' (size), 'decode', 'flatten' and
+        'transform'. Request stages also carry url and spot_id. This base
+        class does nothing; install a subclass with set_observer.
+    """
+
+    def observe(self, stage, seconds, **info):
+        pass
+
+
+class LoggingObserver(Observer):
+    """Logs every stage to logger at level."""
+
+    def __init__(self, logger=None, level=logging.DEBUG):
+        self.logger = logger or logging.getLogger(__name__)
+        self.level = level
+
+    def observe(self, stage, seconds, **info):
+        self.logger.log(self.level, '%s %.2fms %s', stage, seconds * 1e3,
+                        ' '.join('{}={}'.format(k, v)
+                                 for k, v in sorted(info.items())))
+
+
+class MetricsObserver(Observer):
+    """
+        Prometheus-style in-process metrics: a latency histogram per stage,
+        plus counters for response status codes, retries, bytes downloaded
+        and cache hits/misses. render() returns the text exposition format.
+    """
+
+    def __init__(self, buckets=HISTOGRAM_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.histograms = {}
+        self.counters = {}
+        self._lock = threading.Lock()
+
+    def _inc(self, name, labels, amount=1):
+        key = (name, labels)
+        self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, stage, seconds, **info):
+        with self._lock:
+            counts, total = self.histograms.get(
+                stage, ([0] * (len(self.buckets) + 1), 0.0))
+            index = bisect.bisect_left(self.buckets, seconds)
+            counts[index] += 1
+            self.histograms[stage] = (counts, total + seconds)
+            if stage == 'cache':
+                self._inc('msw_cache_total',
+                          (('result', 'hit' if info.get('hit') else 'miss'),))
+            elif stage == 'response':
+                self._inc('msw_responses_total',
+                          (('status', str(info.get('status'))),))
+                self._inc('msw_retries_total', (), info.get('retries', 0))
+            elif stage == 'download':
+                self._inc('msw_download_bytes_total', (), info.get('size', 0))
+
+    def render(self):
+        """Metrics in the Prometheus text exposition format."""
+        lines = []
+        with self._lock:
+            for stage, (counts, total) in sorted(self.histograms.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets + ('+Inf',), counts):
+                    cumulative += count
+                    lines.append('msw_stage_seconds_bucket{{stage="{}",le="{}"}} {}'
+                                 .format(stage, bound, cumulative))
+                lines.append('msw_stage_seconds_sum{{stage="{}"}} {}'
+                             .format(stage, total))
+                lines.append('msw_stage_seconds_count{{stage="{}"}} {}'
+                             .format(stage, cumulative))
+            for (name, labels), value in sorted(self.counters.items()):
+                label_text = ','.join('{}="{}"'.format(k, v)
+                                      for k, v in labels)
+                lines.append('{}{} {}'.format(
+                    name, '{' + label_text + '}' if labels else '', value))
+        return '\n'.join(lines) + '\n'
+
+
+_observer = None
+
+
+def set_observer(observer):
+    """Install observer for every stage (None to disable), returning the old."""
+    global _observer
+    previous, _observer = _observer, observer
+    return previous
 
-    json_d = msw_response.json()
-    headers = msw_response.headers
 
+def _timed(stage, func, *args):
+    """Call func, reporting its duration to the observer if one is set."""
+    observer = _observer
+    if observer is None:
+        return func(*args)
+    start = time.perf_counter()
+    result = func(*args)
+    observer.observe(stage, time.perf_counter() - start)
+    return result
+
+
+def _request_info(requestURL):
+    spot_ids = parse_qs(urlsplit(requestURL).query).get('spot_id')
+    return {'url': requestURL, 'spot_id': spot_ids[0] if spot_ids else None}
+
+
+def _observe_response(observer, requestURL, msw_response, seconds):
+    info = _request_info(requestURL)
+    info['status'] = msw_response.status_code
+    retries = getattr(msw_response.raw, 'retries', None)
+    info['retries'] = len(getattr(retries, 'history', None) or ())
+    waited = msw_response.elapsed.total_seconds()
+    observer.observe('response', waited, **info)
+    observer.observe('download', max(seconds - waited, 0),
+                     size=len(msw_response.content or b''), **info)
+
+
+def cache_key(requestURL):
+    """Normalize a request url into a cache key without the api key."""
+    parts = urlsplit(requestURL)
+    segments = parts.path.split('/')
+    if 'api' in segments:
+        index = segments.index('api') + 1
+        del segments[index:index + 1]
+    path = '/'.join(segments)
+    query = urlencode(sorted(parse_qsl(parts.query)))
+    return urlunsplit((parts.scheme, parts.netloc, path, query, ''))
+
+
+def response_ttl(headers, json_d, now=None):
+    """
+        Seconds a response stays fresh. Uses Cache-Control max-age or
+        Expires when sent, else the time until the next forecast issue
+        after the newest issueTimestamp.
+    """
+    now = time.time() if now is None else now
+    headers = headers or {}
+    for directive in headers.get('Cache-Control', '').split(','):
+        directive = directive.strip().lower()
+        if directive in ('no-store', 'no-cache'):
+            return 0
+        if directive.startswith('max-age='):
+            try:
+                return max(0, int(directive[len('max-age='):]))
+            except ValueError:
+                pass
+    expires = headers.get('Expires')
+    if expires:
+        try:
+            return max(0, int(parsedate_to_datetime(expires).timestamp() - now))
+        except (TypeError, ValueError):
+            return 0
+    issued = [point.get('issueTimestamp') for point in json_d
+              if isinstance(point, dict) and point.get('issueTimestamp')]
+    if not issued:
+        return 0
+    return max(MIN_CACHE_TTL, int(max(issued) + ISSUE_INTERVAL - now))
+
+
+def _raise_for_error_response(json_d):
     if ERROR_RESPONSE in json_d:
         code = json_d.get(ERROR_RESPONSE).get('code')
         msg = json_d.get(ERROR_RESPONSE).get('error_msg')
         raise requests.exceptions.HTTPError(
             'API returned error code {}. {}'.format(code, msg))
+
+
+def _build_forecast(json_d, headers, response, compact=False,
+                    projection=None):
     if len(json_d) == 1:
-        return ForecastDataPoint(json_d[0], headers, msw_response)
-    return ForecastDataBlock(json_d, headers, msw_response)
+        if compact:
+            return CompactDataPoint(json_d[0], projection)
+        return ForecastDataPoint(json_d[0], headers, response, projection)
+    return ForecastDataBlock(json_d, headers, response, compact, projection)
+
+
+def get_msw(requestURL, client=None, compact=False, projection=None):
+    """
+        Get MSW API response, through client's session and cache if given.
+        With compact, points are CompactDataPoints and no response is kept.
+        With a FieldProjection, points only flatten the projected fields.
+        Concurrent identical calls share one fetch on a coalescing client.
+    """
+    flight = client.single_flight if client is not None else None
+    if flight is not None:
+        return flight.do((requestURL, compact, projection),
+                         functools.partial(_get_msw, requestURL, client,
+                                           compact, projection))
+    return _get_msw(requestURL, client, compact, projection)
+
+
+def _get_msw(requestURL, client, compact, projection=None):
+    observer = _observer
+    cache = client.cache if client is not None else None
+    if cache is not None:
+        key = cache_key(requestURL)
+        cached = cache.get(key)
+        if observer is not None:
+            observer.observe('cache', 0.0, hit=cached is not None,
+                             **_request_info(requestURL))
+        if cached is not None:
+            json_d, headers = cached
+            return _build_forecast(
+                json_d, requests.structures.CaseInsensitiveDict(headers), None,
+                compact, projection)
+
+    start = time.perf_counter()
+    if client is not None:
+        msw_response = client.get(requestURL)
+    else:
+        msw_response = requests.get(requestURL)
+    if observer is not None:
+        _observe_response(observer, requestURL, msw_response,
+                          time.perf_counter() - start)
+    if client is not None and msw_response.status_code == NOT_MODIFIED:
+        return client.previous(requestURL, compact, projection)
+    msw_response.raise_for_status()
+
+    json_d = _timed('decode', msw_response.json)
+    headers = msw_response.headers
+    _raise_for_error_response(json_d)
+
+    if cache is not None:
+        ttl = response_ttl(headers, json_d)
+        if ttl:
+            cache.set(key, (json_d, dict(headers)), ttl)
+    result = _build_forecast(json_d, headers, msw_response, compact,
+                             projection)
+    if client is not None:
+        client.remember(requestURL, headers, json_d, result, compact,
+                        projection)
+    return result
+
+
+class SingleFlight():
+    """
+        Shares one in-flight call among concurrent callers asking for the
+        same key, from threads or coroutines. stats counts calls made and
+        calls coalesced onto another caller's fetch.
+    """
+
+    def __init__(self):
+        self.stats = {'calls': 0, 'coalesced': 0}
+        self._inflight = {}
+        self._lock = threading.Lock()
+
+    def _join(self, key):
+        with self._lock:
+            future = self._inflight.get(key)
+            if future is not None:
+                self.stats['coalesced'] += 1
+                return future, False
+            future = self._inflight[key] = Future()
+            self.stats['calls'] += 1
+            return future, True
+
+    def _lead(self, key, future, func):
+        try:
+            result = func()
+        except BaseException as e:
+            with self._lock:
+                del self._inflight[key]
+            future.set_exception(e)
+            raise
+        with self._lock:
+            del self._inflight[key]
+        future.set_result(result)
+        return result
+
+    def do(self, key, func):
+        """Call func, or wait for the identical call already in flight."""
+        future, leader = self._join(key)
+        if leader:
+            return self._lead(key, future, func)
+        return future.result()
+
+    async def do_async(self, key, func, executor=None):
+        """Like do, running func on executor, or the loop's default."""
+        future, leader = self._join(key)
+        if not leader:
+            return await asyncio.wrap_future(future)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(executor, self._lead, key, future,
+                                          func)
+
+
+class MemoryCache():
+    """In-memory LRU response cache holding up to maxsize entries."""
+
+    def __init__(self, maxsize=DEFAULT_CACHE_SIZE):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires <= time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._entries[key] = (time.time() + ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class DiskCache():
+    """On-disk response cache, one JSON file per key under path."""
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+    def _file(self, key):
+        name = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        return os.path.join(self.path, name + '.json')
+
+    def get(self, key):
+        try:
+            with open(self._file(key), 'r') as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if entry['expires'] <= time.time():
+            return None
+        return entry['json'], entry['headers']
+
+    def set(self, key, value, ttl):
+        json_d, headers = value
+        entry = {'expires': time.time() + ttl, 'json': json_d,
+                 'headers': headers}
+        filename = self._file(key)
+        tmp = '{}.{}.tmp'.format(filename, threading.get_ident())
+        with open(tmp, 'w') as f:
+            json.dump(entry, f)
+        os.replace(tmp, filename)
+
+    def clear(self):
+        for name in os.listdir(self.path):
+            if name.endswith('.json'):
+                os.remove(os.path.join(self.path, name))
+
+
+def _iter_json_array(chunks):
+    """
+        Incrementally decode a JSON array from an iterable of byte chunks,
+        yielding each element as soon as it is complete. A non-array body
+        (an MSW error response) is decoded whole and raised as HTTPError.
+    """
+    decoder = json.JSONDecoder()
+    text = codecs.getincrementaldecoder('utf-8')()
+    chunks = iter(chunks)
+    buf = ''
+    started = False
+    for chunk in chunks:
+        buf += text.decode(chunk)
+        while True:
+            buf = buf.lstrip()
+            if not buf:
+                break
+            if not started:
+                if buf[0] != '[':
+                    body = buf + ''.join(text.decode(c) for c in chunks)
+                    json_d = json.loads(body + text.decode(b'', final=True))
+                    _raise_for_error_response(json_d)
+                    raise ValueError('Expected a JSON array of forecasts')
+                started = True
+                buf = buf[1:]
+            elif buf[0] == ',':
+                buf = buf[1:]
+            elif buf[0] == ']':
+                return
+            else:
+                try:
+                    element, end = decoder.raw_decode(buf)
+                except ValueError:
+                    break
+                buf = buf[end:]
+                yield element
+    raise ValueError('Incomplete JSON array')
+
+
+def stream_msw(requestURL, client=None, compact=False, projection=None):
+    """
+        Stream MSW API response, yielding a ForecastDataPoint (or
+        CompactDataPoint) per forecast while the body is still downloading.
+        Bypasses the client's cache and conditional requests.
+    """
+    if client is not None:
+        msw_response = client.get(requestURL, stream=True)
+    else:
+        msw_response = requests.get(requestURL, stream=True)
+    try:
+        msw_response.raise_for_status()
+        for d in _iter_json_array(
+                msw_response.iter_content(STREAM_CHUNK_SIZE)):
+            if compact:
+                yield CompactDataPoint(d, projection)
+            else:
+                yield ForecastDataPoint(d, projection=projection)
+    finally:
+        msw_response.close()
+
+
+async def async_get_msw(requestURL, client=None, projection=None,
+                        executor=None):
+    """
+        Get MSW API response without blocking the event loop, running the
+        request on executor, or the loop's default executor.
+    """
+    flight = client.single_flight if client is not None else None
+    if flight is not None:
+        return await flight.do_async(
+            (requestURL, False, projection),
+            functools.partial(_get_msw, requestURL, client, False, projection),
+            executor)
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor, functools.partial(
+        get_msw, requestURL, client, projection=projection))
+
+
+async def async_fetch_many(api_key, spot_ids, fields=None, unit=None,
+                           window='all', start=None, end=None, client=None,
+                           concurrency=DEFAULT_CONCURRENCY):
+    """
+        Fetch one window for many spots concurrently on a pool of
+        concurrency threads. Returns (results, errors), both dicts keyed
+        by spot_id, like fetch_many.
+    """
+    if window not in WINDOWS:
+        raise ValueError('Invalid window: {}'.format(window))
+
+    def url(spot_id):
+        forecast = MSW_Forecast(api_key, spot_id, fields, unit, client)
+        return forecast.window_url(window, start, end)
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        fetched = await asyncio.gather(
+            *[async_get_msw(url(spot_id), client, executor=executor)
+              for spot_id in spot_ids], return_exceptions=True)
+    results = {}
+    errors = {}
+    for spot_id, result in zip(spot_ids, fetched):
+        if isinstance(result, (requests.exceptions.RequestException,
+                               ValueError)):
+            errors[spot_id] = result
+        elif isinstance(result, BaseException):
+            raise result
+        else:
+            results[spot_id] = result
+    return results, errors
+
+
+def fetch_many(api_key, spot_ids, fields=None, unit=None, window='all',
+               start=None, end=None, client=None,
+               max_workers=DEFAULT_CONCURRENCY):
+    """
+        Fetch one window for many spots on a bounded thread pool.
+        Returns (results, errors), both dicts keyed by spot_id. A failing
+        spot lands in errors instead of aborting the batch.
+    """
+    if window not in WINDOWS:
+        raise ValueError('Invalid window: {}'.format(window))
+
+    def fetch(spot_id):
+        forecast = MSW_Forecast(api_key, spot_id, fields, unit, client)
+        return get_msw(forecast.window_url(window, start, end), client)
+
+    results = {}
+    errors = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [(spot_id, executor.submit(fetch, spot_id))
+                   for spot_id in spot_ids]
+        for spot_id, future in futures:
+            try:
+                results[spot_id] = future.result()
+            except (requests.exceptions.RequestException, ValueError) as e:
+                errors[spot_id] = e
+    return results, errors
+
+
+class RateLimiter():
+    """
+        Thread-safe token bucket allowing rate requests per second with
+        bursts of up to burst. clock and sleep can be swapped for tests.
+    """
+
+    def __init__(self, rate, burst=1, clock=time.monotonic, sleep=time.sleep):
+        self.rate = rate
+        self.burst = burst
+        self.clock = clock
+        self.sleep = sleep
+        self._tokens = burst
+        self._last = clock()
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        """Take a token, returning the seconds to wait before using it."""
+        with self._lock:
+            now = self.clock()
+            self._tokens = min(self.burst,
+                               self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            self._tokens -= 1
+            if self._tokens >= 0:
+                return 0
+            return -self._tokens / self.rate
+
+    def acquire(self):
+        """Block until a token is available."""
+        wait = self.reserve()
+        if wait:
+            self.sleep(wait)
+
+
+class _LimitedRetry(Retry):
+    """Retry taking a rate_limiter token before every retried request."""
+    rate_limiter = None
+
+    def new(self, **kwargs):
+        retry = super().new(**kwargs)
+        retry.rate_limiter = self.rate_limiter
+        return retry
+
+    def increment(self, *args, **kwargs):
+        retry = super().increment(*args, **kwargs)
+        if self.rate_limiter is not None:
+            self.rate_limiter.acquire()
+        return retry
+
+
+def _retryable(error):
+    if isinstance(error, (requests.exceptions.ConnectionError,
+                          requests.exceptions.Timeout,
+                          requests.exceptions.RetryError)):
+        return True
+    response = getattr(error, 'response', None)
+    return (isinstance(error, requests.exceptions.HTTPError)
+            and response is not None
+            and response.status_code in RETRY_STATUSES)
+
+
+class PollScheduler():
+    """
+        Polls many forecasts once per interval seconds, spacing them evenly
+        across the interval and retrying 429/5xx or connection failures
+        with jittered exponential backoff. Give the forecasts a client with
+        retries=0 to retry here rather than in the client.
+    """
+
+    def __init__(self, forecasts, interval, window='current',
+                 retries=DEFAULT_RETRIES, backoff_factor=DEFAULT_BACKOFF,
+                 clock=time.monotonic, sleep=time.sleep):
+        if window not in WINDOWS or window == 'manual':
+            raise ValueError('Invalid window: {}'.format(window))
+        self.forecasts = list(forecasts)
+        self.interval = interval
+        self.window = window
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self.clock = clock
+        self.sleep = sleep
+
+    def schedule(self, start):
+        """(due time, forecast) pairs for one cycle beginning at start."""
+        step = self.interval / max(len(self.forecasts), 1)
+        return [(start + i * step, forecast)
+                for i, forecast in enumerate(self.forecasts)]
+
+    def poll(self, forecast):
+        """
+            Fetch forecast's window, retrying transient failures. Only one
+            layer retries: a client with its own retries is left to them.
+        """
+        client = forecast.client
+        retries = self.retries if client is None or not client.retries else 0
+        for attempt in range(retries + 1):
+            try:
+                return get_msw(forecast.window_url(self.window),
+                               forecast.client)
+            except requests.exceptions.RequestException as e:
+                if attempt == retries or not _retryable(e):
+                    raise
+                self.sleep(random.uniform(0, self.backoff_factor * 2 ** attempt))
+
+    def run_once(self):
+        """Poll every forecast once, yielding (spot_id, result, error)."""
+        start = self.clock()
+        for due, forecast in self.schedule(start):
+            wait = due - self.clock()
+            if wait > 0:
+                self.sleep(wait)
+            try:
+                yield forecast.spot_id, self.poll(forecast), None
+            except (requests.exceptions.RequestException, ValueError) as e:
+                yield forecast.spot_id, None, e
+
+    def run(self, cycles=None):
+        """Repeat run_once every interval, forever or for cycles cycles."""
+        cycle = 0
+        while cycles is None or cycle < cycles:
+            start = self.clock()
+            for polled in self.run_once():
+                yield polled
+            cycle += 1
+            wait = start + self.interval - self.clock()
+            if wait > 0 and (cycles is None or cycle < cycles):
+                self.sleep(wait)
+
+
+def _points_by_time(result):
+    """Map localTimestamp to flattened point for a block or point."""
+    points = result.data if isinstance(result, ForecastDataBlock) else [result]
+    return {point.f_d.get('localTimestamp'): point.f_d for point in points}
+
+
+def diff_points(previous, current):
+    """
+        Compare two localTimestamp -> flattened point mappings. Yields
+        (localTimestamp, changes) for every point of current that is new
+        or has a changed field, changes holding only those fields. Fields
+        in DIFF_IGNORED alone never count as a change.
+    """
+    for local_timestamp, f_d in current.items():
+        before = previous.get(local_timestamp, {})
+        changes = {key: value for key, value in f_d.items()
+                   if key not in before or before[key] != value}
+        if any(key not in DIFF_IGNORED for key in changes):
+            yield local_timestamp, changes
+
+
+def json_lines_publisher(stream=None):
+    """Publisher writing each record as one JSON line to stream."""
+    def publish(record):
+        out = stream or sys.stdout
+        out.write(json.dumps(record, sort_keys=True) + '\n')
+        out.flush()
+    return publish
+
+
+class ForecastPoller():
+    """
+        Long-running poller. Runs scheduler, diffs each result against the
+        previous one for the same spot by (localTimestamp, field) and
+        passes only changed points to publish, as dicts with spot_id,
+        localTimestamp, issueTimestamp and changes. Failed polls are
+        published as dicts with spot_id and error.
+    """
+
+    def __init__(self, scheduler, publish):
+        self.scheduler = scheduler
+        self.publish = publish
+        self.previous = {}
+
+    def run(self, cycles=None):
+        for spot_id, result, error in self.scheduler.run(cycles):
+            if error is not None:
+                self.publish({'spot_id': spot_id, 'error': str(error)})
+                continue
+            current = _points_by_time(result)
+            for local_timestamp, changes in diff_points(
+                    self.previous.get(spot_id, {}), current):
+                self.publish({
+                    'spot_id': spot_id,
+                    'localTimestamp': local_timestamp,
+                    'issueTimestamp':
+                        current[local_timestamp].get('issueTimestamp'),
+                    'changes': changes,
+                })
+            self.previous[spot_id] = current
+
+
+def main(argv=None):
+    """Poll spots on a schedule, printing changed points as JSON lines."""
+    parser = argparse.ArgumentParser(
+        prog='magicseaweed',
+        description='Poll Magic Seaweed forecasts and print changed points '
+                    'as JSON lines.')
+    parser.add_argument('spot_ids', nargs='+', help='spot ids to poll')
+    parser.add_argument('--api-key', default=os.environ.get('MSW_API_KEY'),
+                        help='API key, defaults to $MSW_API_KEY')
+    parser.add_argument('--interval', type=float,
+                        default=DEFAULT_POLL_INTERVAL,
+                        help='seconds between polls of the same spot')
+    parser.add_argument('--window', default='all',
+                        choices=[w for w in WINDOWS if w != 'manual'])
+    parser.add_argument('--fields', help='comma separated fields to request')
+    parser.add_argument('--unit', choices=UNITS)
+    parser.add_argument('--rate', type=float,
+                        help='max requests per second across all spots')
+    parser.add_argument('--cycles', type=int,
+                        help='stop after this many polls of every spot')
+    args = parser.parse_args(argv)
+    if not args.api_key:
+        parser.error('an API key is required, via --api-key or MSW_API_KEY')
+
+    rate_limiter = RateLimiter(args.rate) if args.rate else None
+    with MSW_Client(retries=0, conditional=True,
+                    rate_limiter=rate_limiter) as client:
+        forecasts = [MSW_Forecast(args.api_key, spot_id, args.fields,
+                                  args.unit, client)
+                     for spot_id in args.spot_ids]
+        scheduler = PollScheduler(forecasts, args.interval, args.window)
+        poller = ForecastPoller(scheduler, json_lines_publisher())
+        try:
+            poller.run(args.cycles)
+        except KeyboardInterrupt:
+            pass
+    return 0
+
+
+class MSW_Client():
+    """
+        Owns a pooled requests.Session shared by every forecast using it.
+
+        pool_size:      Max connections kept alive per host
+        timeout:        Seconds, or a (connect, read) tuple, per request
+        retries:        Total retries for connection errors and RETRY_STATUSES
+        backoff_factor: Exponential backoff factor between retries
+        cache:          Optional MemoryCache/DiskCache consulted by get_msw
+        conditional:    Send ETag/Last-Modified validators on repeated polls
+                        and reuse the previous result on 304 Not Modified
+        rate_limiter:   Optional RateLimiter acquired before every request,
+                        retries included
+        coalesce:       Share one fetch among concurrent identical get_msw
+                        calls; see single_flight.stats
+    """
+
+    def __init__(self, pool_size=DEFAULT_POOL_SIZE, timeout=DEFAULT_TIMEOUT,
+                 retries=DEFAULT_RETRIES, backoff_factor=DEFAULT_BACKOFF,
+                 cache=None, conditional=False, rate_limiter=None,
+                 coalesce=False):
+        self.timeout = timeout
+        self.cache = cache
+        self.rate_limiter = rate_limiter
+        self.single_flight = SingleFlight() if coalesce else None
+        self.stats = {'polls': 0, 'not_modified': 0}
+        self._stats_lock = threading.Lock()
+        self._validators = MemoryCache() if conditional else None
+        self.retries = retries
+        retry = _LimitedRetry(total=retries, backoff_factor=backoff_factor,
+                              status_forcelist=RETRY_STATUSES,
+                              allowed_methods=[HTTP_GET])
+        retry.rate_limiter = rate_limiter
+        adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size,
+                                                pool_maxsize=pool_size,
+                                                max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def get(self, url, stream=False):
+        """GET url on the pooled session, conditionally if enabled."""
+        headers = {}
+        validator = None if stream else self._validator(url)
+        if validator is not None:
+            etag, last_modified = validator[:2]
+            if etag:
+                headers['If-None-Match'] = etag
+            if last_modified:
+                headers['If-Modified-Since'] = last_modified
+        if self.rate_limiter is not None:
+            self.rate_limiter.acquire()
+        response = self.session.get(url, headers=headers, stream=stream,
+                                    timeout=self.timeout)
+        with self._stats_lock:
+            self.stats['polls'] += 1
+            if response.status_code == NOT_MODIFIED:
+                self.stats['not_modified'] += 1
+        return response
+
+    def _validator(self, url):
+        if self._validators is None:
+            return None
+        return self._validators.get(url)
+
+    def remember(self, url, headers, json_d, result, compact=False,
+                 projection=None):
+        """
+            Keep url's validators, decoded payload and parsed result for
+            the next poll. result is reused as is for the same compact and
+            projection, and the payload is rebuilt for any other.
+        """
+        if self._validators is None:
+            return
+        etag = headers.get('ETag')
+        last_modified = headers.get('Last-Modified')
+        if etag or last_modified:
+            self._validators.set(url, (etag, last_modified, json_d, headers,
+                                       {(compact, projection): result}),
+                                 float('inf'))
+
+    def previous(self, url, compact=False, projection=None):
+        """
+            Parsed result from the last 200 response for url, built with
+            compact and projection.
+        """
+        validator = self._validator(url)
+        if validator is None:
+            raise requests.exceptions.HTTPError(
+                'Not modified, but no previous response for {}'.format(url))
+        _, _, json_d, headers, results = validator
+        key = (compact, projection)
+        if key not in results:
+            results[key] = _build_forecast(json_d, headers, None, compact,
+                                           projection)
+        return results[key]
+
+    def close(self):
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
 
 
 class MSW_Forecast():
 
-    def __init__(self, api_key, spot_id, fields=None, unit=None):
+    def __init__(self, api_key, spot_id, fields=None, unit=None, client=None,
+                 slice_all=False):
         self.api_key = api_key
         self.spot_id = spot_id
+        self.projection = None
+        if fields:
+            if not isinstance(fields, FieldProjection):
+                fields = compile_fields(fields)
+            self.projection = fields
+            fields = fields.query
         self.fields = fields
         self.unit = unit
+        self.client = client
+        self.slice_all = slice_all
+        self._all = None
+
+    def _window_range(self, window, start=None, end=None):
+        if window == 'current':
+            start = end = int(dt.now().timestamp())
+        elif window == 'future':
+            now = dt.now()
+            start = int(now.timestamp())
+            end = int((now + timedelta(hours=96)).timestamp())
+        elif window == 'all':
+            start = end = None
+        elif window != 'manual':
+            raise ValueError('Invalid window: {}'.format(window))
+        return start, end
+
+    def window_url(self, window, start=None, end=None):
+        """Build the request url for one of WINDOWS."""
+        start, end = self._window_range(window, start, end)
+        return build_request(self.api_key, self.spot_id, self.projection,
+                             self.unit, start, end)
+
+    def _resolve(self, window, start=None, end=None):
+        """(slice of the kept get_all response or None, request url)."""
+        start, end = self._window_range(window, start, end)
+        sliced = None
+        if self.slice_all and window != 'all':
+            if start and end:
+                sliced = self._slice(float(start), float(end))
+            else:
+                kept = self._kept()
+                sliced = kept and kept[1]
+        return sliced, build_request(self.api_key, self.spot_id,
+                                     self.projection, self.unit, start, end)
+
+    def _keep_all(self, result):
+        """Keep a get_all block for slicing while it is fresh."""
+        if not self.slice_all or not isinstance(result, ForecastDataBlock):
+            return result
+        times = [point.f_d.get('localTimestamp') for point in result.data]
+        if not times or not all(isinstance(t, int) for t in times) \
+                or times != sorted(times):
+            self._all = None
+            return result
+        ttl = response_ttl(result.headers,
+                           [point.f_d for point in result.data])
+        self._all = (time.time() + ttl, times, result)
+        return result
+
+    def _kept(self):
+        """
+            (times, block) of the kept get_all block, read in one go so
+            another thread replacing it cannot mix the two, or None when
+            nothing fresh is kept.
+        """
+        kept = self._all
+        if kept is None:
+            return None
+        expires, times, block = kept
+        if expires <= time.time():
+            if self._all is kept:
+                self._all = None
+            return None
+        return times, block
+
+    def _slice(self, start, end):
+        """
+            Points of the kept get_all block whose 3 hour slot overlaps
+            [start, end], found by bisecting localTimestamp. None when
+            nothing is kept, it has expired or it does not cover the range.
+        """
+        kept = self._kept()
+        if kept is None:
+            return None
+        times, block = kept
+        if start < times[0] or end >= times[-1] + FORECAST_INTERVAL:
+            return None
+        lo = bisect.bisect_right(times, start) - 1
+        hi = bisect.bisect_right(times, end)
+        points = block.data[lo:hi]
+        if not points:
+            return None
+        if len(points) == 1:
+            return points[0]
+        sliced = ForecastDataBlock(None, block.headers)
+        sliced.data = points
+        return sliced
 
     def get_current(self):
         """Get current forecast."""
-        now = dt.now().timestamp()
-        url = build_request(self.api_key, self.spot_id, self.fields,
-                            self.unit, now, now)
-        return get_msw(url)
+        sliced, url = self._resolve('current')
+        return sliced or get_msw(url, self.client, projection=self.projection)
 
     def get_future(self):
         """Get current and future forecasts."""
-        now = dt.now()
-        four_days = now + timedelta(hours=96)
-        now = now.timestamp()
-        four_days = four_days.timestamp()
-        url = build_request(self.api_key, self.spot_id, self.fields,
-                            self.unit, now, four_days)
-        return get_msw(url)
+        sliced, url = self._resolve('future')
+        return sliced or get_msw(url, self.client, projection=self.projection)
 
     def get_all(self):
         """Get default forecasts, some in past."""
-        url = build_request(self.api_key, self.spot_id, self.fields,
-                            self.unit, None, None)
-        return get_msw(url)
+        return self._keep_all(get_msw(self.window_url('all'), self.client,
+                                      projection=self.projection))
 
     def get_manual(self, start, end):
         """Get forecasts for a manually selected time period."""
-        url = build_request(self.api_key, self.spot_id, self.fields,
-                            self.unit, start, end)
-        return get_msw(url)
+        sliced, url = self._resolve('manual', start, end)
+        return sliced or get_msw(url, self.client, projection=self.projection)
+
+    def stream(self, window='all', start=None, end=None, compact=False):
+        """Yield forecast points for a window as they are parsed."""
+        return stream_msw(self.window_url(window, start, end), self.client,
+                          compact, self.projection)
+
+
+class AsyncMSW_Forecast(MSW_Forecast):
+    """MSW_Forecast whose getters are coroutines."""
+
+    async def get_current(self):
+        """Get current forecast."""
+        sliced, url = self._resolve('current')
+        return sliced or await async_get_msw(url, self.client, self.projection)
+
+    async def get_future(self):
+        """Get current and future forecasts."""
+        sliced, url = self._resolve('future')
+        return sliced or await async_get_msw(url, self.client, self.projection)
+
+    async def get_all(self):
+        """Get default forecasts, some in past."""
+        return self._keep_all(
+            await async_get_msw(self.window_url('all'), self.client,
+                                self.projection))
+
+    async def get_manual(self, start, end):
+        """Get forecasts for a manually selected time period."""
+        sliced, url = self._resolve('manual', start, end)
+        return sliced or await async_get_msw(url, self.client, self.projection)
+
+
+_UNSET = object()
+
+
+def _arrow_urls(template):
+    """Arrow url for every 5 degree step from 0 to 360."""
+    return {degrees: template.format(degrees) for degrees in range(0, 361, 5)}
+
+
+SWELL_ARROW_URLS = _arrow_urls(SWELL_ARROW_URL)
+WIND_ARROW_URLS = _arrow_urls(WIND_ARROW_URL)
+
+
+def _arrow_url(urls, template, direction):
+    """Url for direction rounded to 5 degrees, from the precomputed urls."""
+    if direction is None:
+        return None
+    rounded = int(5 * round(float(direction)/5))
+    url = urls.get(rounded)
+    return url if url is not None else template.format(rounded)
+
+
+def _swell_direction_key(swell_type):
+    if swell_type not in SWELL_TYPES:
+        raise ValueError('Invalid swell type: {}'.format(swell_type))
+    return "swell_components_{}_direction".format(swell_type)
+
+
+@functools.lru_cache(maxsize=DEFAULT_CACHE_SIZE)
+def weather_url(weather):
+    """Weather icon url for a condition.weather code."""
+    return WEATHER_URL.format(weather)
+
+
+def _typed_array(values, typecode):
+    """int64 ('q') or float64 ('d') array, NumPy-backed when available."""
+    if np is not None:
+        return np.array(values, dtype=np.int64 if typecode == 'q'
+                        else np.float64)
+    return array(typecode, values)
 
 
 class ForecastDataBlock():
 
-    def __init__(self, d=None, headers=None, response=None):
+    def __init__(self, d=None, headers=None, response=None, compact=False,
+                 projection=None):
         d = d or {}
         self.headers = headers
-        self.response = response
-        self.data = [ForecastDataPoint(datapoint)
-                     for datapoint in d]
-        self.summary = self._summary(self.data)
+        self.response = None if compact else response
+        if compact:
+            self.data = [CompactDataPoint(datapoint, projection)
+                         for datapoint in d]
+        else:
+            self.data = [ForecastDataPoint(datapoint, projection=projection)
+                         for datapoint in d]
+        self._summary_text = None
+        self._columns = None
+
+    @property
+    def columns(self):
+        """Cached result of to_arrays()."""
+        if self._columns is None:
+            self._columns = self.to_arrays()
+        return self._columns
+
+    def swell_urls(self, swell_type):
+        """Swell arrow url of every point, None where direction is missing."""
+        key = _swell_direction_key(swell_type)
+        return [_arrow_url(SWELL_ARROW_URLS, SWELL_ARROW_URL,
+                           point.f_d.get(key)) for point in self.data]
+
+    def wind_urls(self):
+        """Wind arrow url of every point, None where direction is missing."""
+        return [_arrow_url(WIND_ARROW_URLS, WIND_ARROW_URL,
+                           point.f_d.get('wind_direction'))
+                for point in self.data]
+
+    def weather_urls(self):
+        """Weather icon url of every point, None where weather is missing."""
+        return [point.get_weather_url() for point in self.data]
+
+    def time_labels(self, field='localTimestamp', tz=None):
+        """Labels for field of every point, in tz when given."""
+        return time_labels([point.f_d.get(field) for point in self.data], tz)
+
+    def save(self, path):
+        """Write data to path in the ForecastSnapshot binary format."""
+        write_snapshot(path, [point.f_d for point in self.data])
+
+    @classmethod
+    def load(cls, path):
+        """Block of CompactDataPoints read from a snapshot file."""
+        with ForecastSnapshot(path) as snapshot:
+            return snapshot.block()
+
+    def to_arrays(self):
+        """
+            Columnar view of data keyed by flattened field name. Timestamps
+            are int64 arrays, other numeric fields float64 arrays with nan
+            for missing values (NumPy when installed, array.array
+            otherwise), and remaining fields plain lists.
+        """
+        flats = [point.f_d for point in self.data]
+        columns = {}
+        for key, _ in FIELD_PATHS:
+            values = [f_d.get(key) for f_d in flats]
+            present = [value for value in values if value is not None]
+            if not present:
+                continue
+            if not all(isinstance(value, (int, float))
+                       and not isinstance(value, bool) for value in present):
+                columns[key] = values
+            elif key in TIMESTAMP_FIELDS and len(present) == len(values):
+                columns[key] = _typed_array(values, 'q')
+            else:
+                columns[key] = _typed_array(
+                    [float('nan') if value is None else value
+                     for value in values], 'd')
+        return columns
+
+    @property
+    def summary(self):
+        if self._summary_text is None:
+            self._summary_text = self._summary(self.data)
+        return self._summary_text
 
     def _summary(self, d):
         try:
@@ -215,13 +1382,34 @@ class ForecastDataBlock():
 
 class ForecastDataPoint():
 
-    def __init__(self, d={}, headers=None, response=None):
+    def __init__(self, d={}, headers=None, response=None, projection=None):
         self.d = d
-        self.f_d = _flatten(d)
-        self.attrs = _forecast_transform(self.f_d)
         self.headers = headers
         self.response = response
-        self.summary = self._summary(d)
+        self._paths = FIELD_PATHS if projection is None else projection.paths
+        self._f_d = None
+        self._attrs = None
+        self._summary_text = _UNSET
+
+    @property
+    def f_d(self):
+        """Flattened forecast dict, built on first access."""
+        if self._f_d is None:
+            self._f_d = _timed('flatten', _flatten, self.d, self._paths)
+        return self._f_d
+
+    @property
+    def attrs(self):
+        """Human-readable attribute dict, built on first access."""
+        if self._attrs is None:
+            self._attrs = _timed('transform', _forecast_transform, self.f_d)
+        return self._attrs
+
+    @property
+    def summary(self):
+        if self._summary_text is _UNSET:
+            self._summary_text = self._summary(self.d)
+        return self._summary_text
 
     def _summary(self, d):
         try:
@@ -233,9 +1421,8 @@ class ForecastDataPoint():
             return None
 
     def __getattr__(self, name):
-        dot = name.replace('_', '.')
-        if dot not in FIELD_TYPES:
-            raise ValueError("{} not a valid field type".format(dot))
+        if name not in FLAT_FIELDS:
+            raise ValueError("{} not a valid field type".format(name.replace('_', '.')))
         try:
             return self.f_d[name]
         except KeyError:
@@ -243,20 +1430,596 @@ class ForecastDataPoint():
 
     def get_swell_url(self, swell_type):
         """Get swell arrow url."""
-        if swell_type not in SWELL_TYPES:
-            raise ValueError('Invalid swell type: {}'.format(swell_type))
-        key = "swell_components_{}_direction".format(swell_type)
-        swell_direction = self.f_d.get(key)
-        if swell_direction is not None:
-            rounded = int(5 * round(float(swell_direction)/5))
-            return SWELL_ARROW_URL.format(rounded)
+        return _arrow_url(SWELL_ARROW_URLS, SWELL_ARROW_URL,
+                          self.f_d.get(_swell_direction_key(swell_type)))
 
     def get_wind_url(self):
         """Get wind arrow url."""
-        wind_direction = self.f_d.get('wind_direction', None)
-        if wind_direction is not None:
-            rounded = int(5 * round(float(wind_direction)/5))
-            return WIND_ARROW_URL.format(rounded)
+        return _arrow_url(WIND_ARROW_URLS, WIND_ARROW_URL,
+                          self.f_d.get('wind_direction', None))
+
+    def get_weather_url(self):
+        """Get weather icon url."""
+        weather = self.f_d.get('condition_weather', None)
+        if weather is not None:
+            return weather_url(weather)
+
+
+class CompactDataPoint():
+    """
+        Slim forecast point holding one slot per FIELD_PATHS key, with
+        numbers kept as numbers. No raw dicts, headers or response are
+        retained; f_d, attrs and summary are rebuilt on access.
+    """
+    __slots__ = tuple(key for key, _ in FIELD_PATHS)
+
+    def __init__(self, d={}, projection=None):
+        paths = FIELD_PATHS if projection is None else projection.paths
+        for key, value in _timed('flatten', _flatten, d, paths).items():
+            setattr(self, key, value)
+
+    @classmethod
+    def from_flat(cls, f_d):
+        """Build a point from an already flattened forecast dict."""
+        point = cls.__new__(cls)
+        for key, value in f_d.items():
+            setattr(point, key, value)
+        return point
+
+    @property
+    def f_d(self):
+        f_d = {}
+        for key in self.__slots__:
+            try:
+                f_d[key] = object.__getattribute__(self, key)
+            except AttributeError:
+                pass
+        return f_d
+
+    @property
+    def attrs(self):
+        return _timed('transform', _forecast_transform, self.f_d)
+
+    @property
+    def summary(self):
+        attrs = self.attrs
+        try:
+            return "{} - {} at {}".format(attrs['min_breaking_height'],
+                                          attrs['max_breaking_height'],
+                                          attrs['begins'])
+        except KeyError:
+            return None
+
+    def __getattr__(self, name):
+        if name not in FLAT_FIELDS:
+            raise ValueError("{} not a valid field type".format(name.replace('_', '.')))
+        return PropertyUnavailable("Property {} is unavailable for this forecast".format(name))
+
+    get_swell_url = ForecastDataPoint.get_swell_url
+    get_wind_url = ForecastDataPoint.get_wind_url
+    get_weather_url = ForecastDataPoint.get_weather_url
+
+
+def _is_number(value, types):
+    return isinstance(value, types) and not isinstance(value, bool)
+
+
+def _snapshot_column(values):
+    """
+        Pick a column kind ('q', 'd' or 's') and pack values for it, where
+        _UNSET marks a missing key. Also returns a uint8 TAG_* array when
+        explicit nulls, or ints in a float column, would otherwise be lost,
+        and None when the column needs no tags.
+    """
+    present = [value for value in values
+               if value is not _UNSET and value is not None]
+    if all(_is_number(value, int) for value in present):
+        kind = b'q'
+        packed = array('q', [value if _is_number(value, int) else MISSING_INT
+                             for value in values])
+    elif all(_is_number(value, (int, float)) for value in present):
+        kind = b'd'
+        packed = array('d', [value if _is_number(value, (int, float))
+                             else float('nan') for value in values])
+    else:
+        kind = b's'
+        packed = [None if value is _UNSET else value for value in values]
+    tags = array('B', [
+        TAG_MISSING if value is _UNSET else
+        TAG_NULL if value is None else
+        TAG_INT if kind == b'd' and _is_number(value, int) else
+        TAG_VALUE for value in values])
+    if TAG_NULL not in tags and TAG_INT not in tags:
+        tags = None
+    return kind, packed, tags
+
+
+def write_snapshot(path, flats):
+    """
+        Write flattened forecast dicts as a fixed-layout snapshot: a header,
+        a column directory, one packed little-endian column per FIELD_PATHS
+        key present (int64, float64 or uint32 string ids), then an interned
+        string table. Missing values are MISSING_INT, nan or MISSING_STRING.
+        Columns holding explicit nulls, or ints among floats, also get a
+        uint8 tag per value so both round-trip exactly.
+    """
+    strings = {}
+
+    def intern(text):
+        return strings.setdefault(text, len(strings))
+
+    columns = []
+    for key, _ in FIELD_PATHS:
+        values = [f_d.get(key, _UNSET) for f_d in flats]
+        if all(value is _UNSET for value in values):
+            continue
+        kind, packed, tags = _snapshot_column(values)
+        if kind == b's':
+            packed = array('I', [MISSING_STRING if value is None
+                                 else intern(str(value)) for value in packed])
+        columns.append((intern(key), kind, packed, tags))
+
+    offset = SNAPSHOT_HEADER.size + SNAPSHOT_COLUMN.size * len(columns)
+    directory = []
+    body = []
+    for name, kind, packed, tags in columns:
+        offset += -offset % 8
+        column_offset = offset
+        if sys.byteorder != 'little':
+            packed.byteswap()
+        data = packed.tobytes()
+        body.append((offset, data))
+        offset += len(data)
+        tags_offset = 0
+        if tags is not None:
+            tags_offset = offset
+            body.append((offset, tags.tobytes()))
+            offset += len(tags)
+        directory.append(SNAPSHOT_COLUMN.pack(name, kind, column_offset,
+                                              tags_offset))
+
+    encoded = [text.encode('utf-8') for text in strings]
+    offset += -offset % 8
+    table_offset = offset
+    string_offsets = array('Q')
+    position = table_offset + 8 * (len(encoded) + 1)
+    for text in encoded:
+        string_offsets.append(position)
+        position += len(text)
+    string_offsets.append(position)
+    if sys.byteorder != 'little':
+        string_offsets.byteswap()
+
+    with open(path, 'wb') as f:
+        f.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION,
+                                     len(columns), len(flats), len(encoded),
+                                     table_offset))
+        f.write(b''.join(directory))
+        for start, data in body:
+            f.write(b'\0' * (start - f.tell()))
+            f.write(data)
+        f.write(b'\0' * (table_offset - f.tell()))
+        f.write(string_offsets.tobytes())
+        f.write(b''.join(encoded))
+
+
+class ForecastSnapshot():
+    """
+        Read-only mmap of a snapshot file written by write_snapshot or
+        ForecastDataBlock.save. Numeric columns are memoryviews over the
+        mapping, so nothing is copied or parsed until values are read.
+    """
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._buffer = memoryview(self._mmap)
+        self._views = {}
+        try:
+            self._open(path)
+        except struct.error:
+            self.close()
+            raise ValueError('Truncated forecast snapshot: {}'.format(path))
+        except ValueError:
+            self.close()
+            raise
+
+    def _open(self, path):
+        magic, version, ncolumns, self.npoints, nstrings, table = \
+            SNAPSHOT_HEADER.unpack_from(self._buffer)
+        if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+            raise ValueError('Not a forecast snapshot: {}'.format(path))
+        self._directory = [SNAPSHOT_COLUMN.unpack_from(
+            self._buffer, SNAPSHOT_HEADER.size + SNAPSHOT_COLUMN.size * i)
+            for i in range(ncolumns)]
+        self._string_offsets = self._cast(table, 'Q', nstrings + 1)
+        if nstrings and self._string_offsets[-1] > len(self._buffer):
+            raise ValueError('Truncated forecast snapshot: {}'.format(path))
+        self._kinds = {}
+        for name, kind, offset, tags_offset in self._directory:
+            typecode = 'I' if kind == b's' else kind.decode('ascii')
+            self._check(offset, array(typecode).itemsize * self.npoints)
+            if tags_offset:
+                self._check(tags_offset, self.npoints)
+            self._kinds[self.string(name)] = (kind, offset, tags_offset)
+
+    def _check(self, offset, size):
+        if offset + size > len(self._buffer):
+            raise ValueError('Truncated forecast snapshot')
+
+    def _cast(self, offset, typecode, count):
+        """Typed view of count values at offset, made once and reused."""
+        cached = self._views.get((offset, typecode))
+        if cached is not None:
+            return cached[0]
+        size = array(typecode).itemsize
+        self._check(offset, size * count)
+        raw = self._buffer[offset:offset + size * count]
+        if sys.byteorder != 'little':
+            values = array(typecode, raw)
+            values.byteswap()
+            view = memoryview(values)
+        else:
+            view = raw.cast(typecode)
+        self._views[offset, typecode] = (view, raw)
+        return view
+
+    def string(self, index):
+        """Interned string number index."""
+        start = self._string_offsets[index]
+        end = self._string_offsets[index + 1]
+        return self._buffer[start:end].tobytes().decode('utf-8')
+
+    @property
+    def names(self):
+        return list(self._kinds)
+
+    def column(self, name):
+        """
+            Raw column: an int64 or float64 memoryview for numeric fields,
+            a uint32 memoryview of string ids for the rest.
+        """
+        kind, offset, _ = self._kinds[name]
+        typecode = 'I' if kind == b's' else kind.decode('ascii')
+        return self._cast(offset, typecode, self.npoints)
+
+    def _decode(self, name):
+        """Column values with their original types, _UNSET where missing."""
+        kind, _, tags_offset = self._kinds[name]
+        column = self.column(name)
+        if kind == b'q':
+            values = [_UNSET if value == MISSING_INT else value
+                      for value in column]
+        elif kind == b'd':
+            values = [_UNSET if value != value else value for value in column]
+        else:
+            values = [_UNSET if value == MISSING_STRING else self.string(value)
+                      for value in column]
+        if not tags_offset:
+            return values
+        tags = self._cast(tags_offset, 'B', self.npoints)
+        return [_UNSET if tag == TAG_MISSING else
+                None if tag == TAG_NULL else
+                int(value) if tag == TAG_INT else
+                value for value, tag in zip(values, tags)]
+
+    def values(self, name):
+        """Column as a list of Python values, None where missing or null."""
+        return [None if value is _UNSET else value
+                for value in self._decode(name)]
+
+    def block(self):
+        """
+            Materialise a ForecastDataBlock of CompactDataPoints. This
+            decodes every value and is slower than json.load of the same
+            payload; read column() or values() for the fast path.
+        """
+        flats = [{} for _ in range(self.npoints)]
+        for name in self._kinds:
+            for f_d, value in zip(flats, self._decode(name)):
+                if value is not _UNSET:
+                    f_d[name] = value
+        block = ForecastDataBlock(None, None, compact=True)
+        block.data = [CompactDataPoint.from_flat(f_d) for f_d in flats]
+        return block
+
+    def close(self):
+        """
+            Release every view and unmap the file. Slices of a column the
+            caller still holds keep the mapping alive until they are freed.
+        """
+        for view, raw in self._views.values():
+            view.release()
+            raw.release()
+        self._views = {}
+        self._buffer.release()
+        try:
+            self._mmap.close()
+        except BufferError:
+            pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class AssetCache():
+    """
+        Image bytes for arrow, weather and chart urls. Each url is fetched
+        once, through client's session when given, then served from an
+        in-memory LRU of memory_size entries and from path on disk if set.
+    """
+
+    def __init__(self, path=None, client=None, memory_size=DEFAULT_CACHE_SIZE):
+        self.path = path
+        self.client = client
+        self._memory = MemoryCache(memory_size)
+        if path:
+            os.makedirs(path, exist_ok=True)
+
+    def _file(self, url):
+        name = hashlib.sha1(url.encode('utf-8')).hexdigest()
+        return os.path.join(self.path, name + os.path.splitext(
+            urlsplit(url).path)[1])
+
+    def get(self, url):
+        """Bytes for url, downloading it only on the first request."""
+        data = self._memory.get(url)
+        if data is not None:
+            return data
+        if self.path:
+            try:
+                with open(self._file(url), 'rb') as f:
+                    data = f.read()
+            except OSError:
+                data = None
+        if data is None:
+            if self.client is not None:
+                response = self.client.session.get(
+                    url, timeout=self.client.timeout)
+            else:
+                response = requests.get(url, timeout=DEFAULT_TIMEOUT)
+            response.raise_for_status()
+            data = response.content
+            if self.path:
+                filename = self._file(url)
+                tmp = '{}.{}.tmp'.format(filename, threading.get_ident())
+                with open(tmp, 'wb') as f:
+                    f.write(data)
+                os.replace(tmp, filename)
+        self._memory.set(url, data, float('inf'))
+        return data
+
+    def prefetch(self, urls, max_workers=DEFAULT_CONCURRENCY):
+        """
+            Download every distinct url not yet cached on a thread pool.
+            Returns a dict of url to error for the ones that failed.
+        """
+        urls = [url for url in OrderedDict.fromkeys(urls) if url]
+        errors = {}
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [(url, executor.submit(self.get, url)) for url in urls]
+            for url, future in futures:
+                try:
+                    future.result()
+                except (requests.exceptions.RequestException, OSError) as e:
+                    errors[url] = e
+        return errors
+
+
+def _iter_raw_responses(source):
+    """
+        (source name, raw JSON text) for each archived response: every
+        *.json file of a directory, or every non-blank line of a JSONL file.
+    """
+    if os.path.isdir(source):
+        for name in sorted(os.listdir(source)):
+            if name.endswith('.json'):
+                with open(os.path.join(source, name), 'r') as f:
+                    yield name, f.read()
+        return
+    with open(source, 'r') as f:
+        for number, line in enumerate(f, 1):
+            if line.strip():
+                yield '{}:{}'.format(os.path.basename(source), number), line
+
+
+def _ingest_chunk(chunk, fields=None):
+    """
+        Worker: parse, flatten and transform a chunk of raw responses into
+        plain record dicts. An error response or invalid JSON becomes one
+        record with source and error instead.
+    """
+    paths = FIELD_PATHS
+    if fields:
+        if not isinstance(fields, FieldProjection):
+            fields = compile_fields(fields)
+        paths = fields.paths
+    records = []
+    for source, text in chunk:
+        try:
+            json_d = json.loads(text)
+            if not isinstance(json_d, list):
+                if isinstance(json_d, dict):
+                    _raise_for_error_response(json_d)
+                raise ValueError('Expected a list of forecasts')
+        except (ValueError, requests.exceptions.HTTPError) as e:
+            records.append({'source': source, 'error': str(e)})
+            continue
+        for d in json_d:
+            f_d = _flatten(d, paths)
+            try:
+                attrs = _forecast_transform(f_d)
+            except (TypeError, ValueError, OverflowError):
+                attrs = None
+            records.append({'source': source, 'f_d': f_d, 'attrs': attrs})
+    return records
+
+
+def ingest(source, fields=None, processes=None, chunk_size=INGEST_CHUNK_SIZE):
+    """
+        Stream archived raw MSW responses from a directory or JSONL file
+        and yield one record per forecast point, as dicts with source, f_d
+        and attrs, or one with source and error for each response that is
+        invalid JSON or an API error. Chunks of chunk_size responses are parsed on a pool of
+        processes (one per core by default, inline when processes is 1),
+        with at most two chunks per process in flight.
+    """
+    chunks = _chunks(_iter_raw_responses(source), chunk_size)
+    if processes == 1:
+        for chunk in chunks:
+            for record in _ingest_chunk(chunk, fields):
+                yield record
+        return
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        in_flight = deque()
+        limit = 2 * (processes or os.cpu_count() or 1)
+        for chunk in chunks:
+            in_flight.append(executor.submit(_ingest_chunk, chunk, fields))
+            if len(in_flight) >= limit:
+                for record in in_flight.popleft().result():
+                    yield record
+        while in_flight:
+            for record in in_flight.popleft().result():
+                yield record
+
+
+def ingest_to_file(source, output, **kwargs):
+    """
+        Write ingest point records to output as JSON lines. Returns (count,
+        errors): the number of records written and a dict of source to
+        error message for every response that was skipped.
+    """
+    count = 0
+    errors = {}
+    with open(output, 'w') as f:
+        for record in ingest(source, **kwargs):
+            if 'error' in record:
+                errors[record['source']] = record['error']
+                continue
+            f.write(json.dumps(record) + '\n')
+            count += 1
+    return count, errors
+
+
+def _chunks(iterable, size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+class ForecastStore():
+    """
+        SQLite archive of forecast points, one row per (spot_id,
+        issueTimestamp, localTimestamp) with a column per FIELD_PATHS key.
+        path defaults to an in-memory database.
+    """
+    COLUMNS = tuple(key for key, _ in FIELD_PATHS)
+
+    def __init__(self, path=':memory:'):
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        columns = ', '.join('"{}"'.format(key) for key in self.COLUMNS
+                            if key not in ('issueTimestamp', 'localTimestamp'))
+        with self._lock, self._conn:
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS forecasts ('
+                'spot_id TEXT NOT NULL, '
+                '"issueTimestamp" INTEGER NOT NULL, '
+                '"localTimestamp" INTEGER NOT NULL, {}, '
+                'PRIMARY KEY (spot_id, "issueTimestamp", "localTimestamp"))'
+                .format(columns))
+            self._conn.execute(
+                'CREATE INDEX IF NOT EXISTS forecasts_by_time ON forecasts '
+                '(spot_id, "localTimestamp", "issueTimestamp")')
+
+    def add(self, spot_id, result):
+        """
+            Bulk insert a get_msw result (block or point), replacing rows
+            with the same key. Points without both timestamps are skipped.
+            Returns the number of rows written.
+        """
+        points = result.data if isinstance(result, ForecastDataBlock) \
+            else [result]
+        rows = []
+        for point in points:
+            f_d = point.f_d
+            if f_d.get('issueTimestamp') is None \
+                    or f_d.get('localTimestamp') is None:
+                continue
+            rows.append((str(spot_id),) + tuple(f_d.get(key)
+                                                for key in self.COLUMNS))
+        sql = 'INSERT OR REPLACE INTO forecasts (spot_id, {}) VALUES ({})'.format(
+            ', '.join('"{}"'.format(key) for key in self.COLUMNS),
+            ', '.join('?' * (len(self.COLUMNS) + 1)))
+        with self._lock, self._conn:
+            self._conn.executemany(sql, rows)
+        return len(rows)
+
+    def _rows(self, sql, params):
+        cursor = self._conn.execute(sql, params)
+        names = [column[0] for column in cursor.description]
+        return [{name: value for name, value in zip(names, row)
+                 if value is not None} for row in cursor.fetchall()]
+
+    def _query(self, sql, params):
+        with self._lock:
+            return self._rows(sql, params)
+
+    def latest(self, spot_id, start=None, end=None):
+        """Most recently issued row for each localTimestamp in [start, end]."""
+        return self._query(
+            'SELECT * FROM forecasts AS f WHERE spot_id = ? '
+            'AND "localTimestamp" BETWEEN ? AND ? '
+            'AND "issueTimestamp" = (SELECT MAX("issueTimestamp") '
+            'FROM forecasts WHERE spot_id = f.spot_id '
+            'AND "localTimestamp" = f."localTimestamp") '
+            'ORDER BY "localTimestamp"',
+            (str(spot_id), -2 ** 63 if start is None else start,
+             2 ** 63 - 1 if end is None else end))
+
+    def history(self, spot_id, local_timestamp):
+        """Every issued row for one localTimestamp, oldest issue first."""
+        return self._query(
+            'SELECT * FROM forecasts WHERE spot_id = ? '
+            'AND "localTimestamp" = ? ORDER BY "issueTimestamp"',
+            (str(spot_id), local_timestamp))
+
+    def skill(self, spot_id, field, observations):
+        """
+            Forecast skill for field against observations, a dict of
+            localTimestamp to observed value. Lead time is the UTC
+            timestamp minus issueTimestamp. Returns a list of dicts with
+            lead_hours, count and mean_abs_error, shortest lead first.
+        """
+        if field not in self.COLUMNS:
+            raise ValueError('Invalid field type: {}'.format(field))
+        with self._lock, self._conn:
+            self._conn.execute('CREATE TEMP TABLE IF NOT EXISTS observations '
+                               '(ts INTEGER PRIMARY KEY, value REAL)')
+            self._conn.execute('DELETE FROM observations')
+            self._conn.executemany('INSERT INTO observations VALUES (?, ?)',
+                                   observations.items())
+            return self._rows(
+                'SELECT ("timestamp" - "issueTimestamp") / 3600 AS lead_hours, '
+                'COUNT(*) AS count, '
+                'AVG(ABS(f."{0}" - o.value)) AS mean_abs_error '
+                'FROM forecasts AS f JOIN observations AS o '
+                'ON o.ts = f."localTimestamp" '
+                'WHERE f.spot_id = ? AND f."{0}" IS NOT NULL '
+                'AND f."timestamp" IS NOT NULL '
+                'GROUP BY lead_hours ORDER BY lead_hours'.format(field),
+                (str(spot_id),))
+
+    def close(self):
+        self._conn.close()
 
 
 class PropertyUnavailable(AttributeError):
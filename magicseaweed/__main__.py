@@ -0,0 +1,5 @@
+import sys
+
+from magicseaweed import main
+
+sys.exit(main())
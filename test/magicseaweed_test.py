@@ -1,8 +1,18 @@
 import os
 import json
+import asyncio
+import tempfile
+import io
+import sqlite3
+import threading
 import unittest
+from datetime import timedelta, timezone
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, HTTPServer
 from unittest.mock import MagicMock, patch
 
+import requests
+
 import magicseaweed
 
 # randomly generated, not a real api key
@@ -30,6 +40,102 @@ def prepare_mock(mock_requests, status_code, fixture_filename):
     mock_requests.get.return_value = mock_response
 
 
+class FixtureHandler(BaseHTTPRequestHandler):
+    """Serves a fixture file for every GET, counting requests."""
+    fixture = 'success_response.json'
+    status = 200
+    hits = 0
+
+    def do_GET(self):
+        type(self).hits += 1
+        body = json.dumps(load_test_fixture(self.fixture)).encode()
+        self.send_response(self.status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class ETagHandler(FixtureHandler):
+    """Serves the fixture with an ETag, 304 when it is sent back."""
+
+    def do_GET(self):
+        if self.headers.get('If-None-Match') == '"v1"':
+            type(self).hits += 1
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.etag = '"v1"'
+        FixtureHandler.do_GET(self)
+
+    def end_headers(self):
+        if getattr(self, 'etag', None):
+            self.send_header('ETag', self.etag)
+        FixtureHandler.end_headers(self)
+
+
+class UnavailableHandler(FixtureHandler):
+    """Answers every GET with 503."""
+    status = 503
+    fixture = 'error_response.json'
+
+
+class ErrorSpotHandler(FixtureHandler):
+    """Serves the error fixture for spot_id=bad."""
+
+    def do_GET(self):
+        if 'spot_id=bad' in self.path:
+            self.fixture = 'error_response.json'
+        FixtureHandler.do_GET(self)
+
+
+class FakeClock():
+    """Clock whose sleep advances time instantly, recording each wait."""
+
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+class GatedHandler(FixtureHandler):
+    """Holds every response until gate is set."""
+    gate = threading.Event()
+
+    def do_GET(self):
+        self.gate.wait(5)
+        FixtureHandler.do_GET(self)
+
+
+def release_when(condition, gate):
+    """Set gate from a background thread once condition() holds."""
+    def wait():
+        for _ in range(500):
+            if condition():
+                break
+            threading.Event().wait(0.01)
+        gate.set()
+    threading.Thread(target=wait, daemon=True).start()
+
+
+def start_stub_server(handler=FixtureHandler):
+    """Start a local stub server on a free port, return (server, url)."""
+    server = HTTPServer(('127.0.0.1', 0), handler)
+    thread = threading.Thread(target=server.serve_forever, args=(0.05,),
+                              daemon=True)
+    thread.start()
+    return server, 'http://127.0.0.1:{}/'.format(server.server_port)
+
+
 class TestHelperFunctions(unittest.TestCase):
 
     def test_invalid_unit(self):
@@ -57,6 +163,22 @@ class TestHelperFunctions(unittest.TestCase):
         fields = "timestamp,wind.*,condition.temperature"
         magicseaweed._validate_field_types(fields)
 
+    def test_flatten_parity(self):
+        def reference_flatten(d, prefix=''):
+            flat = {}
+            for key, value in d.items():
+                if isinstance(value, dict) and value:
+                    flat.update(reference_flatten(value, prefix + key + '_'))
+                else:
+                    flat[prefix + key] = value
+            return flat
+
+        for fixture in ('success_response.json',
+                        'success_current_response.json'):
+            for d in load_test_fixture(fixture):
+                self.assertEqual(magicseaweed._flatten(d),
+                                 reference_flatten(d))
+
     def test_forecast_transform(self):
 
         flattened_json = {
@@ -135,6 +257,62 @@ class TestHelperFunctions(unittest.TestCase):
         self.assertEqual(transformed.get('wind_gusts'), '14 mph')
         self.assertEqual(transformed.get('wind_speed'), '8 mph')
 
+    def test_compile_fields(self):
+        projection = magicseaweed.compile_fields(
+            " timestamp, wind.*, swell.components.primary.* ")
+
+        self.assertEqual(projection.query,
+                         'timestamp,wind.*,swell.components.primary.*')
+        self.assertEqual(projection.keys, frozenset([
+            'timestamp', 'wind_speed', 'wind_direction',
+            'wind_compassDirection', 'wind_chill', 'wind_gusts', 'wind_unit',
+            'swell_components_primary_height',
+            'swell_components_primary_period',
+            'swell_components_primary_direction',
+            'swell_components_primary_compassDirection']))
+        self.assertIs(magicseaweed.compile_fields(
+            " timestamp, wind.*, swell.components.primary.* "), projection)
+        self.assertRaises(ValueError, magicseaweed.compile_fields,
+                          'timestamp,invalid')
+
+    def test_forecast_accepts_compiled_fields(self):
+        projection = magicseaweed.compile_fields('timestamp, wind.*')
+        compiled = magicseaweed.MSW_Forecast(TEST_API_KEY, TEST_SPOT_ID,
+                                             fields=projection)
+        text = magicseaweed.MSW_Forecast(TEST_API_KEY, TEST_SPOT_ID,
+                                         fields='timestamp, wind.*')
+
+        self.assertIs(compiled.projection, projection)
+        self.assertEqual(compiled.fields, 'timestamp,wind.*')
+        self.assertEqual(compiled.window_url('all'), text.window_url('all'))
+
+    def test_projected_point_keeps_projected_fields(self):
+        d = load_test_fixture('success_response.json')[0]
+        projection = magicseaweed.compile_fields('timestamp,wind.*')
+        for point in (magicseaweed.ForecastDataPoint(d, projection=projection),
+                      magicseaweed.CompactDataPoint(d, projection)):
+            self.assertEqual(set(point.f_d), projection.keys)
+            self.assertEqual(point.wind_speed, d['wind']['speed'])
+            self.assertIsInstance(point.swell_probability,
+                                  magicseaweed.PropertyUnavailable)
+
+    def test_time_labels(self):
+        magicseaweed.time_label.cache_clear()
+        tz = timezone(timedelta(hours=-4))
+
+        labels = magicseaweed.time_labels([1662847200, 1662811200,
+                                           1662847200])
+
+        self.assertEqual(labels, ['Sat 10 PM', 'Sat 12 PM', 'Sat 10 PM'])
+        self.assertEqual(magicseaweed.time_label.cache_info().misses, 2)
+        self.assertEqual(magicseaweed.time_label(1662847200, tz), 'Sat 6 PM')
+
+    def test_block_time_labels(self):
+        block = magicseaweed.ForecastDataBlock(
+            load_test_fixture('success_response.json'))
+        self.assertEqual(block.time_labels(),
+                         [point.attrs['begins'] for point in block.data])
+
     def test_build_request_defaults(self):
         want = ('http://magicseaweed.com/api/Cu4do7TrIWzDXnZm3XvhX7c5Zfk0HpI2/'
                 'forecast?spot_id=123')
@@ -189,6 +367,786 @@ class TestHelperFunctions(unittest.TestCase):
                           magicseaweed.get_msw, TEST_URL)
 
 
+class Test_MSW_Client(unittest.TestCase):
+
+    def test_client_mounts_pooled_adapter(self):
+        client = magicseaweed.MSW_Client(pool_size=4, retries=2)
+        adapter = client.session.get_adapter('http://magicseaweed.com')
+        self.assertEqual(adapter._pool_maxsize, 4)
+        self.assertEqual(adapter.max_retries.total, 2)
+        client.close()
+
+    def test_get_msw_uses_client(self):
+        client = magicseaweed.MSW_Client()
+        client.session = MagicMock()
+        response = client.session.get.return_value
+        response.status_code = 200
+        response.json.return_value = load_test_fixture(
+            'success_response.json')
+
+        got = magicseaweed.get_msw(TEST_URL, client)
+
+        client.session.get.assert_called_once_with(
+            TEST_URL, headers={}, stream=False, timeout=client.timeout)
+        self.assertEqual(len(got.data), 40)
+
+
+class Test_Cache(unittest.TestCase):
+
+    def setUp(self):
+        FixtureHandler.hits = 0
+        self.server, self.url = start_stub_server()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_cache_key_strips_api_key(self):
+        url = magicseaweed.build_request(TEST_API_KEY, TEST_SPOT_ID,
+                                         unit='us')
+        self.assertEqual(magicseaweed.cache_key(url),
+                         'http://magicseaweed.com/api/forecast?'
+                         'spot_id=123&units=us')
+
+    def test_response_ttl_headers(self):
+        self.assertEqual(magicseaweed.response_ttl(
+            {'Cache-Control': 'public, max-age=120'}, []), 120)
+        self.assertEqual(magicseaweed.response_ttl(
+            {'Cache-Control': 'no-cache'}, []), 0)
+
+    def test_response_ttl_issue_timestamp(self):
+        json_d = [{'issueTimestamp': 1000}, {'issueTimestamp': 4000}]
+        self.assertEqual(magicseaweed.response_ttl(
+            {}, json_d, now=5000), 4000 + magicseaweed.ISSUE_INTERVAL - 5000)
+        self.assertEqual(magicseaweed.response_ttl(
+            {}, json_d, now=10 ** 6), magicseaweed.MIN_CACHE_TTL)
+
+    def test_memory_cache_lru(self):
+        cache = magicseaweed.MemoryCache(maxsize=2)
+        cache.set('a', 1, 60)
+        cache.set('b', 2, 60)
+        cache.get('a')
+        cache.set('c', 3, 60)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertIsNone(cache.get('b'))
+        cache.set('d', 4, 0)
+        self.assertIsNone(cache.get('d'))
+
+    def test_get_msw_served_from_cache(self):
+        with tempfile.TemporaryDirectory() as path:
+            for cache in (magicseaweed.MemoryCache(),
+                          magicseaweed.DiskCache(path)):
+                FixtureHandler.hits = 0
+                with magicseaweed.MSW_Client(cache=cache) as client:
+                    with patch('magicseaweed.response_ttl', return_value=60):
+                        first = magicseaweed.get_msw(self.url, client)
+                    second = magicseaweed.get_msw(self.url, client)
+
+                self.assertEqual(FixtureHandler.hits, 1)
+                self.assertIsNone(second.response)
+                self.assertEqual(first.summary, second.summary)
+
+
+class Test_Conditional(unittest.TestCase):
+
+    def setUp(self):
+        self.server, self.url = start_stub_server(ETagHandler)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_not_modified_reuses_previous_block(self):
+        with magicseaweed.MSW_Client(conditional=True) as client:
+            first = magicseaweed.get_msw(self.url, client)
+            second = magicseaweed.get_msw(self.url, client)
+
+        self.assertIs(first, second)
+        self.assertEqual(client.stats, {'polls': 2, 'not_modified': 1})
+
+    def test_not_modified_respects_compact_and_projection(self):
+        projection = magicseaweed.compile_fields('timestamp')
+        with magicseaweed.MSW_Client(conditional=True) as client:
+            compact = magicseaweed.get_msw(self.url, client, compact=True)
+            full = magicseaweed.get_msw(self.url, client)
+            projected = magicseaweed.get_msw(self.url, client,
+                                             projection=projection)
+
+        self.assertEqual(client.stats, {'polls': 3, 'not_modified': 2})
+        self.assertIsInstance(compact.data[0], magicseaweed.CompactDataPoint)
+        self.assertIsInstance(full.data[0], magicseaweed.ForecastDataPoint)
+        self.assertEqual(len(full.data[0].f_d), len(compact.data[0].f_d))
+        self.assertEqual(set(projected.data[0].f_d), {'timestamp'})
+
+    def test_unconditional_client_sends_no_validators(self):
+        with magicseaweed.MSW_Client() as client:
+            first = magicseaweed.get_msw(self.url, client)
+            second = magicseaweed.get_msw(self.url, client)
+
+        self.assertIsNot(first, second)
+        self.assertEqual(client.stats['not_modified'], 0)
+
+
+class Test_Stream(unittest.TestCase):
+
+    def setUp(self):
+        self.server, self.url = start_stub_server(ErrorSpotHandler)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_iter_json_array_byte_chunks(self):
+        d = load_test_fixture('success_response.json')
+        body = json.dumps(d, ensure_ascii=False).encode('utf-8')
+        chunks = [body[i:i + 7] for i in range(0, len(body), 7)]
+
+        self.assertEqual(list(magicseaweed._iter_json_array(chunks)), d)
+        self.assertRaises(ValueError, list,
+                          magicseaweed._iter_json_array([body[:100]]))
+
+    def test_stream_msw(self):
+        with magicseaweed.MSW_Client() as client:
+            points = magicseaweed.stream_msw(self.url, client)
+            first = next(points)
+            rest = list(points)
+
+        self.assertIsInstance(first, magicseaweed.ForecastDataPoint)
+        self.assertEqual(len(rest), 39)
+        self.assertEqual(first.attrs, magicseaweed.get_msw(
+            self.url).data[0].attrs)
+
+    def test_stream_msw_error(self):
+        points = magicseaweed.stream_msw(self.url + '?spot_id=bad')
+        self.assertRaises(requests.exceptions.HTTPError, list, points)
+
+
+class Test_Rate_Limit(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+
+    def forecasts(self, n):
+        return [magicseaweed.MSW_Forecast(TEST_API_KEY, str(i))
+                for i in range(n)]
+
+    def test_token_bucket(self):
+        limiter = magicseaweed.RateLimiter(2, burst=2, clock=self.clock)
+        waits = [limiter.reserve() for _ in range(4)]
+        self.assertEqual(waits, [0, 0, 0.5, 1.0])
+        self.clock.now = 10
+        self.assertEqual(limiter.reserve(), 0)
+
+    def test_client_acquires_limiter(self):
+        server, url = start_stub_server()
+        limiter = magicseaweed.RateLimiter(1, clock=self.clock,
+                                           sleep=self.clock.sleep)
+        try:
+            with magicseaweed.MSW_Client(rate_limiter=limiter) as client:
+                for _ in range(3):
+                    magicseaweed.get_msw(url, client)
+        finally:
+            server.shutdown()
+            server.server_close()
+        self.assertEqual(self.clock.sleeps, [1.0, 1.0])
+
+    @patch('magicseaweed.get_msw')
+    def test_scheduler_spreads_polls(self, mock_get_msw):
+        scheduler = magicseaweed.PollScheduler(
+            self.forecasts(4), 60, clock=self.clock, sleep=self.clock.sleep)
+
+        polled = list(scheduler.run(cycles=2))
+
+        self.assertEqual([spot_id for spot_id, _, _ in polled],
+                         ['0', '1', '2', '3'] * 2)
+        self.assertEqual(self.clock.sleeps, [15.0] * 7)
+
+    @patch('magicseaweed.get_msw')
+    def test_scheduler_retries_with_backoff(self, mock_get_msw):
+        unavailable = requests.exceptions.HTTPError(
+            response=MagicMock(status_code=503))
+        api_error = requests.exceptions.HTTPError('API returned error code')
+        mock_get_msw.side_effect = [unavailable, unavailable, 'ok', api_error]
+        scheduler = magicseaweed.PollScheduler(
+            self.forecasts(2), 0, clock=self.clock, sleep=self.clock.sleep)
+
+        polled = list(scheduler.run_once())
+
+        self.assertEqual(polled[0], ('0', 'ok', None))
+        self.assertIs(polled[1][2], api_error)
+        self.assertEqual(len(self.clock.sleeps), 2)
+        self.assertLessEqual(self.clock.sleeps[1], 0.6)
+
+    def test_failing_spot_takes_token_per_request(self):
+        server, url = start_stub_server(UnavailableHandler)
+        UnavailableHandler.hits = 0
+        original = magicseaweed.MSW_URL
+        magicseaweed.MSW_URL = url + '{}'
+        try:
+            for client_retries in (0, 2):
+                UnavailableHandler.hits = 0
+                limiter = magicseaweed.RateLimiter(1000)
+                with patch.object(limiter, 'acquire',
+                                  wraps=limiter.acquire) as acquire, \
+                        magicseaweed.MSW_Client(retries=client_retries,
+                                                backoff_factor=0,
+                                                rate_limiter=limiter) as client:
+                    scheduler = magicseaweed.PollScheduler(
+                        [magicseaweed.MSW_Forecast(TEST_API_KEY, '1',
+                                                   client=client)],
+                        0, retries=2, clock=self.clock,
+                        sleep=self.clock.sleep)
+                    polled = list(scheduler.run_once())
+
+                self.assertIsNotNone(polled[0][2])
+                self.assertEqual(UnavailableHandler.hits, 3)
+                self.assertEqual(acquire.call_count, 3)
+        finally:
+            magicseaweed.MSW_URL = original
+            server.shutdown()
+            server.server_close()
+
+
+class Test_Coalesce(unittest.TestCase):
+
+    def setUp(self):
+        GatedHandler.hits = 0
+        GatedHandler.gate.clear()
+        self.server, self.url = start_stub_server(GatedHandler)
+        self.client = magicseaweed.MSW_Client(coalesce=True)
+        stats = self.client.single_flight.stats
+        release_when(lambda: stats['coalesced'] == 3, GatedHandler.gate)
+
+    def tearDown(self):
+        self.client.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_threaded_callers_share_fetch(self):
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            got = list(executor.map(
+                lambda _: magicseaweed.get_msw(self.url, self.client),
+                range(4)))
+
+        self.assertEqual(GatedHandler.hits, 1)
+        self.assertTrue(all(block is got[0] for block in got))
+        self.assertEqual(self.client.single_flight.stats,
+                         {'calls': 1, 'coalesced': 3})
+
+    def test_async_callers_share_fetch(self):
+        async def fetch():
+            return await asyncio.gather(*[
+                magicseaweed.async_get_msw(self.url, self.client)
+                for _ in range(4)])
+
+        got = asyncio.run(fetch())
+
+        self.assertEqual(GatedHandler.hits, 1)
+        self.assertTrue(all(block is got[0] for block in got))
+
+    def test_different_api_keys_do_not_share_fetch(self):
+        stats = self.client.single_flight.stats
+        release_when(lambda: stats['calls'] == 2, GatedHandler.gate)
+        urls = [self.url + 'api/{}/forecast/?spot_id=1'.format(api_key)
+                for api_key in ('key-a', 'key-b')]
+        self.assertEqual(magicseaweed.cache_key(urls[0]),
+                         magicseaweed.cache_key(urls[1]))
+
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            got = list(executor.map(
+                lambda url: magicseaweed.get_msw(url, self.client), urls))
+
+        self.assertEqual(GatedHandler.hits, 2)
+        self.assertIsNot(got[0], got[1])
+        self.assertEqual(stats, {'calls': 2, 'coalesced': 0})
+
+
+class Test_Observer(unittest.TestCase):
+
+    def setUp(self):
+        self.server, self.url = start_stub_server()
+
+    def tearDown(self):
+        magicseaweed.set_observer(None)
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_metrics_observer(self):
+        metrics = magicseaweed.MetricsObserver()
+        magicseaweed.set_observer(metrics)
+        url = self.url + '?spot_id=' + TEST_SPOT_ID
+
+        with magicseaweed.MSW_Client(cache=magicseaweed.MemoryCache()) as client:
+            with patch('magicseaweed.response_ttl', return_value=60):
+                block = magicseaweed.get_msw(url, client)
+            magicseaweed.get_msw(url, client)
+        block.data[0].attrs
+
+        counts = {stage: sum(counts) for stage, (counts, _)
+                  in metrics.histograms.items()}
+        self.assertEqual(counts, {'cache': 2, 'response': 1, 'download': 1,
+                                  'decode': 1, 'flatten': 1, 'transform': 1})
+        self.assertEqual(metrics.counters[(
+            'msw_responses_total', (('status', '200'),))], 1)
+        self.assertEqual(metrics.counters[(
+            'msw_cache_total', (('result', 'hit'),))], 1)
+        self.assertIn('msw_stage_seconds_count{stage="response"} 1',
+                      metrics.render())
+
+    def test_logging_observer(self):
+        magicseaweed.set_observer(magicseaweed.LoggingObserver())
+        url = self.url + '?spot_id=' + TEST_SPOT_ID
+
+        with self.assertLogs('magicseaweed', 'DEBUG') as logs:
+            magicseaweed.get_msw(url)
+
+        self.assertTrue(logs.output[0].startswith(
+            'DEBUG:magicseaweed:response '))
+        self.assertIn('spot_id=123 status=200', logs.output[0])
+
+
+class Test_Asset_Cache(unittest.TestCase):
+
+    def setUp(self):
+        FixtureHandler.hits = 0
+        self.server, self.url = start_stub_server()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_assets_fetched_once(self):
+        urls = [self.url + 'a.png', self.url + 'b.png', self.url + 'a.png']
+        with tempfile.TemporaryDirectory() as path:
+            with magicseaweed.MSW_Client() as client:
+                assets = magicseaweed.AssetCache(path, client)
+                self.assertEqual(assets.prefetch(urls), {})
+                data = assets.get(urls[0])
+            self.assertEqual(FixtureHandler.hits, 2)
+
+            from_disk = magicseaweed.AssetCache(path).get(urls[0])
+
+        self.assertEqual(FixtureHandler.hits, 2)
+        self.assertEqual(from_disk, data)
+        self.assertEqual(json.loads(data.decode('utf-8')),
+                         load_test_fixture('success_response.json'))
+
+
+class Test_Ingest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.source = os.path.join(self.tmp.name, 'archive.jsonl')
+        with open(self.source, 'w') as f:
+            for fixture in ('success_response.json', 'error_response.json',
+                            'success_current_response.json'):
+                f.write(json.dumps(load_test_fixture(fixture)) + '\n')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_ingest_inline_and_process_pool(self):
+        inline = list(magicseaweed.ingest(self.source, processes=1))
+        pooled = list(magicseaweed.ingest(self.source, processes=2,
+                                          chunk_size=1))
+
+        self.assertEqual(inline, pooled)
+        self.assertEqual(len(inline), 42)
+        self.assertEqual(inline[40], {
+            'source': 'archive.jsonl:2',
+            'error': 'API returned error code 501. Invalid parameters were '
+                     'supplied and did not pass our validation, please '
+                     'double check your request.'})
+        self.assertEqual(inline[-1]['source'], 'archive.jsonl:3')
+        point = magicseaweed.ForecastDataPoint(
+            load_test_fixture('success_current_response.json')[0])
+        self.assertEqual(inline[-1]['f_d'], point.f_d)
+        self.assertEqual(inline[-1]['attrs'], point.attrs)
+
+    def test_ingest_to_file(self):
+        output = os.path.join(self.tmp.name, 'records.jsonl')
+
+        with open(self.source, 'a') as f:
+            f.write('{"truncated": \n')
+
+        count, errors = magicseaweed.ingest_to_file(
+            self.source, output, fields='localTimestamp,wind.*', processes=1)
+
+        with open(output, 'r') as f:
+            records = [json.loads(line) for line in f]
+        self.assertEqual(count, 41)
+        self.assertEqual(len(records), 41)
+        self.assertEqual(sorted(errors), ['archive.jsonl:2', 'archive.jsonl:4'])
+        self.assertEqual(set(records[0]['f_d']),
+                         magicseaweed.compile_fields(
+                             'localTimestamp,wind.*').keys)
+        self.assertIsNone(records[0]['attrs'])
+
+
+class Test_Poller(unittest.TestCase):
+
+    def test_diff_points(self):
+        previous = {1: {'localTimestamp': 1, 'issueTimestamp': 10,
+                        'wind_speed': 5},
+                    2: {'localTimestamp': 2, 'issueTimestamp': 10,
+                        'wind_speed': 5}}
+        current = {1: {'localTimestamp': 1, 'issueTimestamp': 20,
+                       'wind_speed': 5},
+                   2: {'localTimestamp': 2, 'issueTimestamp': 20,
+                       'wind_speed': 7},
+                   3: {'localTimestamp': 3, 'wind_speed': 1}}
+
+        got = list(magicseaweed.diff_points(previous, current))
+
+        self.assertEqual(got, [
+            (2, {'issueTimestamp': 20, 'wind_speed': 7}),
+            (3, {'localTimestamp': 3, 'wind_speed': 1})])
+
+    @patch('magicseaweed.get_msw')
+    def test_poller_publishes_changed_points(self, mock_get_msw):
+        d = load_test_fixture('success_response.json')
+        changed = json.loads(json.dumps(d))
+        changed[5]['wind']['speed'] += 1
+        mock_get_msw.side_effect = [magicseaweed.ForecastDataBlock(d),
+                                    magicseaweed.ForecastDataBlock(d),
+                                    magicseaweed.ForecastDataBlock(changed)]
+        clock = FakeClock()
+        scheduler = magicseaweed.PollScheduler(
+            [magicseaweed.MSW_Forecast(TEST_API_KEY, TEST_SPOT_ID)], 60,
+            'all', clock=clock, sleep=clock.sleep)
+        published = []
+
+        magicseaweed.ForecastPoller(scheduler, published.append).run(3)
+
+        self.assertEqual(len(published), 41)
+        self.assertEqual(published[-1], {
+            'spot_id': TEST_SPOT_ID,
+            'localTimestamp': d[5]['localTimestamp'],
+            'issueTimestamp': d[5]['issueTimestamp'],
+            'changes': {'wind_speed': d[5]['wind']['speed'] + 1}})
+
+    def test_main_prints_json_lines(self):
+        server, url = start_stub_server()
+        out = io.StringIO()
+        try:
+            with patch('magicseaweed.MSW_URL', url + '{}'), \
+                    patch('sys.stdout', out):
+                code = magicseaweed.main(['--api-key', TEST_API_KEY,
+                                          '--cycles', '1', TEST_SPOT_ID])
+        finally:
+            server.shutdown()
+            server.server_close()
+
+        lines = [json.loads(line) for line in out.getvalue().splitlines()]
+        self.assertEqual(code, 0)
+        self.assertEqual(len(lines), 40)
+        self.assertEqual(lines[0]['spot_id'], TEST_SPOT_ID)
+
+
+class Test_Async(unittest.TestCase):
+
+    def setUp(self):
+        self.server, self.url = start_stub_server()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_async_get_msw_local_server(self):
+        got = asyncio.run(magicseaweed.async_get_msw(self.url))
+
+        self.assertIsInstance(got, magicseaweed.ForecastDataBlock)
+        self.assertEqual(
+            got.summary, '40 forecasts from Thu 12 AM to Mon 9 PM')
+
+    @patch('magicseaweed.MSW_URL')
+    def test_async_fetch_many(self, mock_url):
+        mock_url.format.return_value = self.url
+        spot_ids = ['1', '2', '3']
+
+        with magicseaweed.MSW_Client() as client, \
+                patch('magicseaweed.ThreadPoolExecutor',
+                      wraps=magicseaweed.ThreadPoolExecutor) as pool:
+            results, errors = asyncio.run(magicseaweed.async_fetch_many(
+                TEST_API_KEY, spot_ids, client=client, concurrency=64))
+
+        pool.assert_called_once_with(max_workers=64)
+        self.assertEqual(list(results), spot_ids)
+        self.assertEqual(errors, {})
+        for block in results.values():
+            self.assertEqual(len(block.data), 40)
+
+    @patch('magicseaweed.MSW_URL')
+    def test_async_fetch_many_collects_errors(self, mock_url):
+        server, url = start_stub_server(ErrorSpotHandler)
+        mock_url.format.return_value = url
+        try:
+            results, errors = asyncio.run(magicseaweed.async_fetch_many(
+                TEST_API_KEY, ['1', 'bad', '2'], concurrency=2))
+        finally:
+            server.shutdown()
+            server.server_close()
+
+        self.assertEqual(list(results), ['1', '2'])
+        self.assertIsInstance(errors['bad'], requests.exceptions.HTTPError)
+
+
+class Test_Fetch_Many(unittest.TestCase):
+
+    def setUp(self):
+        self.server, self.url = start_stub_server(ErrorSpotHandler)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    @patch('magicseaweed.MSW_URL')
+    def test_fetch_many_collects_errors(self, mock_url):
+        mock_url.format.return_value = self.url
+
+        results, errors = magicseaweed.fetch_many(
+            TEST_API_KEY, ['1', 'bad', '2'], max_workers=2)
+
+        self.assertEqual(list(results), ['1', '2'])
+        self.assertEqual(len(results['2'].data), 40)
+        self.assertIsInstance(errors['bad'], requests.exceptions.HTTPError)
+
+    def test_fetch_many_invalid_window(self):
+        self.assertRaises(ValueError, magicseaweed.fetch_many,
+                          TEST_API_KEY, ['1'], window='invalid')
+
+
+class Test_Forecast_Store(unittest.TestCase):
+
+    def setUp(self):
+        self.store = magicseaweed.ForecastStore()
+        self.d = load_test_fixture('success_response.json')
+
+    def tearDown(self):
+        self.store.close()
+
+    def test_add_and_latest(self):
+        block = magicseaweed.ForecastDataBlock(self.d, compact=True)
+        self.assertEqual(self.store.add(TEST_SPOT_ID, block), 40)
+        reissued = json.loads(json.dumps(self.d[0]))
+        reissued['issueTimestamp'] += 3600
+        reissued['swell']['maxBreakingHeight'] = 9
+        self.store.add(TEST_SPOT_ID, magicseaweed.ForecastDataPoint(reissued))
+
+        latest = self.store.latest(TEST_SPOT_ID)
+        history = self.store.history(TEST_SPOT_ID,
+                                     self.d[0]['localTimestamp'])
+
+        self.assertEqual(len(latest), 40)
+        self.assertEqual(latest[0]['swell_maxBreakingHeight'], 9)
+        self.assertEqual(latest[1], dict(block.data[1].f_d,
+                                         spot_id=TEST_SPOT_ID))
+        self.assertEqual([row['issueTimestamp'] for row in history],
+                         [self.d[0]['issueTimestamp'],
+                          self.d[0]['issueTimestamp'] + 3600])
+
+    def test_skill(self):
+        self.store.add(TEST_SPOT_ID, magicseaweed.ForecastDataBlock(self.d))
+        observations = {point['localTimestamp']: point['wind']['speed'] + 2
+                        for point in (self.d[0], self.d[10])}
+
+        got = self.store.skill(TEST_SPOT_ID, 'wind_speed', observations)
+
+        self.assertEqual(got, [
+            {'lead_hours': 0, 'count': 1, 'mean_abs_error': 2.0},
+            {'lead_hours': (self.d[10]['timestamp'] -
+                            self.d[10]['issueTimestamp']) // 3600,
+             'count': 1, 'mean_abs_error': 2.0}])
+        self.assertRaises(ValueError, self.store.skill, TEST_SPOT_ID,
+                          'invalid', observations)
+
+    def test_skill_releases_database_for_other_writers(self):
+        with tempfile.TemporaryDirectory() as path:
+            filename = os.path.join(path, 'forecasts.db')
+            store = magicseaweed.ForecastStore(filename)
+            other = sqlite3.connect(filename, timeout=0)
+            try:
+                store.add(TEST_SPOT_ID, magicseaweed.ForecastDataBlock(self.d))
+                store.skill(TEST_SPOT_ID, 'wind_speed',
+                            {self.d[0]['localTimestamp']: 1})
+
+                self.assertFalse(store._conn.in_transaction)
+                with other:
+                    other.execute('DELETE FROM forecasts')
+            finally:
+                other.close()
+                store.close()
+
+    def test_concurrent_skill_keeps_own_observations(self):
+        self.store.add(TEST_SPOT_ID, magicseaweed.ForecastDataBlock(self.d))
+        point = self.d[0]
+
+        def skill(offset):
+            observations = {point['localTimestamp']:
+                            point['wind']['speed'] + offset}
+            return [self.store.skill(TEST_SPOT_ID, 'wind_speed',
+                                     observations)[0]['mean_abs_error']
+                    for _ in range(50)]
+
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            errors = list(executor.map(skill, (1, 3)))
+
+        self.assertEqual(errors, [[1.0] * 50, [3.0] * 50])
+
+
+class Test_Columns(unittest.TestCase):
+
+    @patch('magicseaweed.np', None)
+    def test_block_columns_array_fallback(self):
+        block = magicseaweed.ForecastDataBlock(
+            load_test_fixture('success_response.json'))
+        columns = block.columns
+
+        self.assertIs(block.columns, columns)
+        self.assertEqual(columns['localTimestamp'].typecode, 'q')
+        self.assertEqual(len(columns['localTimestamp']), 40)
+        self.assertEqual(columns['swell_components_combined_height'].typecode,
+                         'd')
+        self.assertEqual(columns['wind_compassDirection'][0],
+                         block.data[0].wind_compassDirection)
+        self.assertEqual(max(columns['swell_maxBreakingHeight']),
+                         max(point.swell_maxBreakingHeight
+                             for point in block.data))
+
+
+class Test_Compact(unittest.TestCase):
+
+    def test_compact_block_matches_full_block(self):
+        d = load_test_fixture('success_response.json')
+        full = magicseaweed.ForecastDataBlock(d, response=MagicMock())
+        compact = magicseaweed.ForecastDataBlock(d, response=MagicMock(),
+                                                 compact=True)
+
+        self.assertIsNone(compact.response)
+        self.assertEqual(compact.summary, full.summary)
+        for want, got in zip(full.data, compact.data):
+            self.assertIsInstance(got, magicseaweed.CompactDataPoint)
+            self.assertEqual(got.f_d, want.f_d)
+            self.assertEqual(got.attrs, want.attrs)
+            self.assertEqual(got.wind_speed, want.wind_speed)
+            self.assertEqual(got.get_wind_url(), want.get_wind_url())
+        self.assertIsInstance(compact.data[0].swell_components_tertiary_height,
+                              magicseaweed.PropertyUnavailable)
+        self.assertRaises(ValueError, getattr, compact.data[0], 'invalid')
+
+    def test_compact_summary_transforms_once(self):
+        point = magicseaweed.CompactDataPoint(
+            load_test_fixture('success_current_response.json')[0])
+        with patch('magicseaweed._forecast_transform',
+                   wraps=magicseaweed._forecast_transform) as transform:
+            self.assertEqual(point.summary, '2 ft - 4 ft at Sat 9 PM')
+            transform.assert_called_once()
+
+
+class Test_Snapshot(unittest.TestCase):
+
+    def test_snapshot_round_trip(self):
+        block = magicseaweed.ForecastDataBlock(
+            load_test_fixture('success_response.json'))
+        with tempfile.TemporaryDirectory() as path:
+            filename = os.path.join(path, 'block.msw')
+            block.save(filename)
+            loaded = magicseaweed.ForecastDataBlock.load(filename)
+            with magicseaweed.ForecastSnapshot(filename) as snapshot:
+                wind_speed = list(snapshot.column('wind_speed'))
+                self.assertEqual(snapshot.column('localTimestamp').format,
+                                 'q')
+                self.assertEqual(snapshot.values('wind_compassDirection'),
+                                 [point.wind_compassDirection
+                                  for point in block.data])
+
+        self.assertEqual(wind_speed,
+                         [point.wind_speed for point in block.data])
+        for got, want in zip(loaded.data, block.data):
+            self.assertEqual(got.f_d, want.f_d)
+            self.assertEqual({key: type(value)
+                              for key, value in got.f_d.items()},
+                             {key: type(value)
+                              for key, value in want.f_d.items()})
+            self.assertEqual(got.attrs, want.attrs)
+        self.assertEqual(loaded.summary, block.summary)
+
+    def test_snapshot_keeps_nulls_and_ints_among_floats(self):
+        flats = [{'localTimestamp': 1, 'wind_speed': 4, 'wind_gusts': None},
+                 {'localTimestamp': 2, 'wind_speed': 4.5},
+                 {'localTimestamp': 3, 'wind_gusts': 7}]
+        with tempfile.TemporaryDirectory() as path:
+            filename = os.path.join(path, 'block.msw')
+            magicseaweed.write_snapshot(filename, flats)
+            with magicseaweed.ForecastSnapshot(filename) as snapshot:
+                got = [point.f_d for point in snapshot.block().data]
+                wind_speed = snapshot.values('wind_speed')
+
+        self.assertEqual(got, flats)
+        self.assertIs(type(got[0]['wind_speed']), int)
+        self.assertEqual(wind_speed, [4, 4.5, None])
+
+    def test_snapshot_reuses_column_views(self):
+        block = magicseaweed.ForecastDataBlock(
+            load_test_fixture('success_response.json'))
+        with tempfile.TemporaryDirectory() as path:
+            filename = os.path.join(path, 'block.msw')
+            block.save(filename)
+            snapshot = magicseaweed.ForecastSnapshot(filename)
+            views = len(snapshot._views)
+            for _ in range(100):
+                snapshot.values('wind_speed')
+                column = snapshot.column('wind_speed')
+
+            self.assertIs(snapshot.column('wind_speed'), column)
+            self.assertEqual(len(snapshot._views), views + 1)
+            head = column[:3]
+            snapshot.close()
+            self.assertEqual(list(head),
+                             [point.wind_speed for point in block.data[:3]])
+            del head
+
+    def test_snapshot_rejects_other_files(self):
+        with tempfile.NamedTemporaryFile() as f:
+            f.write(b'x' * 64)
+            f.flush()
+            self.assertRaises(ValueError, magicseaweed.ForecastSnapshot,
+                              f.name)
+
+    def test_snapshot_rejects_truncated_files(self):
+        block = magicseaweed.ForecastDataBlock(
+            load_test_fixture('success_response.json'))
+        with tempfile.TemporaryDirectory() as path:
+            filename = os.path.join(path, 'block.msw')
+            block.save(filename)
+            with open(filename, 'rb') as f:
+                data = f.read()
+            for size in (8, 200, len(data) // 2, len(data) - 1):
+                with open(filename, 'wb') as f:
+                    f.write(data[:size])
+                self.assertRaises(ValueError, magicseaweed.ForecastSnapshot,
+                                  filename)
+
+
+class Test_Batch_Urls(unittest.TestCase):
+
+    def test_block_batch_urls(self):
+        block = magicseaweed.ForecastDataBlock(
+            load_test_fixture('success_response.json'))
+
+        self.assertEqual(block.swell_urls('tertiary'),
+                         [point.get_swell_url('tertiary')
+                          for point in block.data])
+        self.assertEqual(block.wind_urls(),
+                         [point.get_wind_url() for point in block.data])
+        self.assertEqual(block.weather_urls()[0],
+                         'http://cdnimages.magicseaweed.com/30x30/10.png')
+        self.assertEqual(block.wind_urls()[0],
+                         magicseaweed.WIND_ARROW_URL.format(
+                             int(5 * round(block.data[0].wind_direction / 5))))
+        self.assertRaises(ValueError, block.swell_urls, 'invalid')
+
+
 class Test_MSW_Forecast(unittest.TestCase):
 
     @patch('magicseaweed.requests')
@@ -217,6 +1175,84 @@ class Test_MSW_Forecast(unittest.TestCase):
         }
         self.assertEqual(got.get_current().attrs, want)
 
+    def test_data_point_is_lazy(self):
+        d = load_test_fixture('success_current_response.json')[0]
+        with patch('magicseaweed._forecast_transform',
+                   wraps=magicseaweed._forecast_transform) as transform:
+            point = magicseaweed.ForecastDataPoint(d)
+            self.assertEqual(point.wind_speed, 1)
+            transform.assert_not_called()
+            self.assertEqual(point.summary, '2 ft - 4 ft at Sat 9 PM')
+            point.attrs
+            transform.assert_called_once()
+
+    @patch('magicseaweed.time')
+    @patch('magicseaweed.requests')
+    def test_slice_all_serves_windows(self, mock_requests, mock_time):
+        mock_time.time.return_value = 1523491200
+        prepare_mock(mock_requests, 200, 'success_response.json')
+        mock_requests.get.return_value.headers = {}
+        forecast = magicseaweed.MSW_Forecast(TEST_API_KEY, TEST_SPOT_ID,
+                                             slice_all=True)
+
+        block = forecast.get_all()
+        got = forecast.get_manual(1523491200 + 3600, 1523491200 + 4 * 10800)
+        point = forecast.get_manual(1523502000, 1523502000)
+
+        self.assertEqual(mock_requests.get.call_count, 1)
+        self.assertEqual(got.data, block.data[0:5])
+        self.assertIs(point, block.data[1])
+        self.assertIs(forecast.get_manual(None, None), block)
+
+        forecast.get_manual(1523912400 + 10800, 1523912400 + 10800)
+        self.assertEqual(mock_requests.get.call_count, 2)
+
+        mock_time.time.return_value += 4 * magicseaweed.ISSUE_INTERVAL
+        forecast.get_manual(1523502000, 1523502000)
+        self.assertEqual(mock_requests.get.call_count, 3)
+
+    @patch('magicseaweed.time')
+    @patch('magicseaweed.requests')
+    def test_slice_reads_kept_block_once(self, mock_requests, mock_time):
+        class RacingForecast(magicseaweed.MSW_Forecast):
+            """Loses the kept block after one read, like a racing thread."""
+            reads = 0
+
+            @property
+            def _all(self):
+                self.reads += 1
+                return self.kept if self.reads == 1 else None
+
+            @_all.setter
+            def _all(self, value):
+                self.kept = value
+
+        mock_time.time.return_value = 1523491200
+        prepare_mock(mock_requests, 200, 'success_response.json')
+        mock_requests.get.return_value.headers = {}
+        forecast = RacingForecast(TEST_API_KEY, TEST_SPOT_ID, slice_all=True)
+        block = forecast.get_all()
+        forecast.reads = 0
+
+        self.assertIs(forecast.get_manual(1523502000, 1523502000),
+                      block.data[1])
+
+    @patch('magicseaweed.requests')
+    def test_slice_all_manual_without_range(self, mock_requests):
+        prepare_mock(mock_requests, 200, 'success_response.json')
+        mock_requests.get.return_value.headers = {}
+        forecast = magicseaweed.MSW_Forecast(TEST_API_KEY, TEST_SPOT_ID,
+                                             slice_all=True)
+
+        got = forecast.get_manual(None, None)
+
+        self.assertEqual(len(got.data), 40)
+        self.assertEqual(mock_requests.get.call_count, 1)
+
+    def test_invalid_window(self):
+        forecast = magicseaweed.MSW_Forecast(TEST_API_KEY, TEST_SPOT_ID)
+        self.assertRaises(ValueError, forecast.window_url, 'invalid')
+
 
 if __name__ == '__main__':
     unittest.main()